@@ -0,0 +1,184 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file is an in-process stand-in for bigquery.Client, serving a synthetic organization to the checks.
+Queries are not executed, they are recognized by the tables they read and answered with the rows BQ would return.
+Tables the checks upload are serialized to Parquet like a real load job and kept in memory, so a later stage can read
+them back. Every job waits for the configured latency before its result is returned, and scans a fixed number of
+bytes for every row it returns.
+Input:
+    1. A SyntheticOrg
+    2. The latency of a job, in seconds
+Output: The results of the queries the checks run
+"""
+
+import io
+import re
+import threading
+import time
+from types import SimpleNamespace
+from google.api_core.exceptions import NotFound
+import pandas as pd
+import pyarrow as pa
+
+# Bytes a fake job scans for every row it returns
+BYTES_PER_ROW = 1000
+
+# Rows in a page of results
+ROWS_PER_PAGE = 10000
+
+JOBS_PATTERN = re.compile(r'`([^`]+)\.`\.`region-us`\.INFORMATION_SCHEMA\.JOBS')
+REGION_PATTERN = re.compile(r'`([^`]+)`\.`(region-[^`]+)`\.INFORMATION_SCHEMA')
+DATASET_PATTERN = re.compile(r'`([^`.]+)\.([^`.]+)\.?`\.(?:__TABLES__|INFORMATION_SCHEMA\.COLUMNS)')
+STORED_TABLE_PATTERN = re.compile(r'FROM\s+`[^`.]+\.Data_Defender\.(\w+)`', re.IGNORECASE)
+COLUMN_SCHEMAS_PATTERN = re.compile(r'FROM\s+`[^`.]+\.Data_Defender\.(column_schemas\w*)`', re.IGNORECASE)
+
+
+class FakeRowIterator:
+    def __init__(self, df):
+        self.df = df
+        self.total_rows = len(df)
+        self.schema = [SimpleNamespace(name=column) for column in df.columns]
+
+    def to_dataframe(self, **kwargs):
+        pages = list(self.to_dataframe_iterable())
+        return pd.concat(pages, ignore_index=True) if pages else self.df.copy()
+
+    def to_dataframe_iterable(self, **kwargs):
+        # Every page is decoded through Arrow like the real client does, so it holds its own strings instead of
+        # sharing the ones of the synthetic organization
+        for start in range(0, len(self.df), ROWS_PER_PAGE):
+            page = self.df.iloc[start:start + ROWS_PER_PAGE]
+            yield pa.Table.from_pandas(page, preserve_index=False).to_pandas()
+
+
+class FakeJob:
+    def __init__(self, latency, df=None, error=None):
+        self.latency = latency
+        self.df = df if df is not None else pd.DataFrame()
+        self.error = error
+        self.destination = None
+        self.job_id = 'fake_job'
+        self.total_bytes_processed = len(self.df) * BYTES_PER_ROW
+        self.total_bytes_billed = self.total_bytes_processed
+        self.slot_millis = int(latency * 1000)
+
+    def result(self):
+        time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return FakeRowIterator(self.df)
+
+
+class FakeClient:
+    def __init__(self, org, latency=0.0, project='benchmark'):
+        self.org = org
+        self.latency = latency
+        self.project = project
+        self.tables = {}
+        self.jobs = 0
+        self._lock = threading.Lock()
+
+    def list_projects(self):
+        time.sleep(self.latency)
+        return [SimpleNamespace(project_id=project) for project in self.org.projects]
+
+    def list_datasets(self, project):
+        time.sleep(self.latency)
+        return [SimpleNamespace(dataset_id=dataset, _properties={'location': 'US'})
+                for dataset in self.org.datasets(project)]
+
+    def _answer(self, query):
+        match = JOBS_PATTERN.search(query)
+        if match:
+            return self.org.project_logs(match.group(1))
+
+        stored = STORED_TABLE_PATTERN.search(query)
+        if '__TABLES__' in query and 'last_modified_time' in query:
+            return self.org.dataset_signatures(DATASET_PATTERN.findall(query))
+        if 'INFORMATION_SCHEMA.COLUMNS' in query or '__TABLES__' in query or 'INFORMATION_SCHEMA.TABLES' in query:
+            region = REGION_PATTERN.search(query)
+            project, dataset = (region.group(1), None) if region else DATASET_PATTERN.search(query).groups()
+            if 'COLUMNS' in query and 'table_catalog, table_schema' in query:
+                return self.org.dataset_columns(project, dataset)
+            if 'COLUMNS' in query:
+                return self.org.unused_columns(project, dataset)
+            return self.org.unused_tables(project, dataset)
+        column_schemas = COLUMN_SCHEMAS_PATTERN.search(query)
+        if column_schemas:
+            return self.org.unused_columns_of(self.tables[column_schemas.group(1).lower()])
+        if query.lstrip().upper().startswith('MERGE'):
+            return pd.DataFrame()
+        if stored:
+            name = stored.group(1).lower()
+            if name not in self.tables:
+                raise NotFound('Table Data_Defender.{} was not found'.format(name))
+            return self.tables[name]
+        raise ValueError('The fake client does not know how to answer: {}'.format(query[:200]))
+
+    def query(self, query, job_config=None, **kwargs):
+        dry_run = job_config is not None and job_config.dry_run
+        if not dry_run:
+            with self._lock:
+                self.jobs += 1
+        try:
+            df = self._answer(query)
+        except Exception as exe:
+            if dry_run:
+                raise
+            return FakeJob(self.latency, error=exe)
+        if dry_run:
+            # A dry run has its estimate as soon as it returns
+            time.sleep(self.latency)
+            return FakeJob(0, df)
+        return FakeJob(self.latency, df)
+
+    def get_table(self, table):
+        name = str(table).split('.')[-1].lower()
+        if name not in self.tables:
+            raise NotFound('Table {} was not found'.format(table))
+        return SimpleNamespace(num_rows=len(self.tables[name]))
+
+    def load_table_from_dataframe(self, df, destination, job_config=None, **kwargs):
+        # Serialized like a real load job, so the benchmark pays for the conversion to Parquet
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        name = destination.table_id.lower()
+        if job_config is not None and job_config.write_disposition == 'WRITE_APPEND' and name in self.tables:
+            df = pd.concat([self.tables[name], df], ignore_index=True)
+        self.tables[name] = df
+        return FakeJob(self.latency)
+
+    def copy_table(self, source, destination, job_config=None, **kwargs):
+        df = self.tables[source.table_id.lower()]
+        name = destination.table_id.lower()
+        if job_config is not None and job_config.write_disposition == 'WRITE_APPEND' and name in self.tables:
+            df = pd.concat([self.tables[name], df], ignore_index=True)
+        self.tables[name] = df
+        return FakeJob(self.latency)
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        name = str(table).split('.')[-1].lower()
+        if name not in self.tables and not not_found_ok:
+            raise NotFound('Table {} was not found'.format(table))
+        self.tables.pop(name, None)
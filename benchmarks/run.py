@@ -0,0 +1,141 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file benchmarks every stage main.py runs against a synthetic organization served by a fake BQ client.
+Each stage runs in its own process, so the peak memory of one stage is not hidden by another.
+Input:
+    1. The sizes (job log rows) to benchmark, the seed and the latency of a fake BQ job
+    2. The options the stages are run with (concurrency, parse workers)
+Output: Wall time, peak RSS and rows per second of every stage and size, printed as a table and optionally as JSON
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STAGES = ['total_logs', 'unused_tables', 'used_columns', 'unused_columns']
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_stage(stage, rows, seed, latency, max_concurrent_jobs, parse_workers):
+    import fake_bigquery
+    import synthetic
+    import parse_cache
+    import parse_pool
+    import total_logs
+    import unused_columns
+    import unused_tables
+    import used_columns
+
+    org = synthetic.SyntheticOrg(rows, seed)
+    client = fake_bigquery.FakeClient(org, latency)
+    if stage == 'used_columns':
+        logs = org.logs.drop(columns='next_watermark')
+        logs.last_run_date = logs.last_run_date.astype('datetime64[ns]')
+        client.tables['total_logs'] = logs
+    input_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    # The output of the stage goes to stderr so stdout only carries the measurements
+    with contextlib.redirect_stdout(sys.stderr):
+        if stage == 'total_logs':
+            total_logs.main(client, client.project, True, max_concurrent_jobs)
+        elif stage == 'unused_tables':
+            unused_tables.main(client, client.project, 0, max_concurrent_jobs)
+        elif stage == 'used_columns':
+            cache = parse_cache.ParseCache()
+            pool = parse_pool.ParsePool(parse_workers, 60)
+            used_columns.main(client, client.project, cache, pool, True)
+            pool.close()
+            cache.close()
+        elif stage == 'unused_columns':
+            unused_columns.main(client, client.project, max_concurrent_jobs)
+    wall_time = time.perf_counter() - start
+
+    return {'stage': stage, 'rows': rows, 'wall_time_s': round(wall_time, 3),
+            'rows_per_s': round(rows / wall_time) if wall_time else None, 'input_rss_mb': round(input_rss, 1),
+            'peak_rss_mb': round(peak_rss_mb(), 1), 'jobs': client.jobs}
+
+
+def benchmark(stage, rows, args):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', stage, '--rows', str(rows),
+               '--seed', str(args.seed), '--latency', str(args.latency),
+               '--max-concurrent-jobs', str(args.max_concurrent_jobs), '--parse-workers', str(args.parse_workers)]
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL,
+                            universal_newlines=True)
+    if output.returncode != 0:
+        print('Stage {} failed on {} rows'.format(stage, rows))
+        return None
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(args):
+    results = []
+    print('{:<16}{:>12}{:>12}{:>14}{:>16}{:>16}{:>8}'.format('stage', 'rows', 'wall s', 'rows/s', 'input RSS MB',
+                                                            'peak RSS MB', 'jobs'))
+    for rows in args.rows:
+        for stage in args.stages:
+            result = benchmark(stage, rows, args)
+            if result is None:
+                continue
+            results.append(result)
+            print('{stage:<16}{rows:>12}{wall_time_s:>12}{rows_per_s:>14}{input_rss_mb:>16}{peak_rss_mb:>16}'
+                  '{jobs:>8}'.format(**result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Data Defender stages on synthetic data")
+    parser.add_argument("--rows", type=int, nargs='+', default=[10000],
+                        help="Sizes to benchmark, in job log rows (e.g. 10000 100000 1000000 10000000)")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=STAGES, help="Stages to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic organization")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every fake BigQuery job takes")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=1,
+                        help="How many BigQuery jobs the stages may run at the same time")
+    parser.add_argument("--parse-workers", type=int, default=1, help="How many processes parse queries")
+    parser.add_argument("--json", default=None, help="Path of a JSON file to write the results to")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the stages")
+    parser.add_argument("--worker", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_stage(args.worker, args.rows[0], args.seed, args.latency, args.max_concurrent_jobs,
+                                   args.parse_workers)))
+    else:
+        main(args)
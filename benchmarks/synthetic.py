@@ -0,0 +1,165 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file generates a synthetic organization for the benchmarks: projects, datasets, sharded and plain tables, their
+columns and the job logs that query them. The same rows and seed always give the same organization.
+Queries come from a limited number of templates with different literals, like the scheduled queries and dashboards
+of a real organization, so the parse cache sees realistic repetition.
+Input:
+    1. The number of job log rows to generate
+    2. The seed
+Output: DataFrames of the job logs (in the shape of total_logs), the tables and the columns
+"""
+
+import numpy as np
+import pandas as pd
+
+ROWS_PER_PROJECT = 100000
+DATASETS_PER_PROJECT = 20
+COLUMNS_PER_TABLE = 10
+# One table for every this many log rows
+ROWS_PER_TABLE = 10
+# One query template for every this many log rows, with different literals each time
+ROWS_PER_TEMPLATE = 20
+USERS = 200
+
+
+class SyntheticOrg:
+    def __init__(self, rows, seed=0):
+        self.rows = rows
+        self.random = np.random.RandomState(seed)
+        self.now = pd.Timestamp('2023-06-01', tz='UTC')
+
+        project_count = max(1, rows // ROWS_PER_PROJECT)
+        table_count = max(1, rows // ROWS_PER_TABLE)
+        self.projects = ['project-{}'.format(i) for i in range(project_count)]
+        self.tables = self._tables(table_count)
+        self.columns = self._columns()
+        self.logs = self._logs(max(1, rows // ROWS_PER_TEMPLATE))
+
+    def _tables(self, table_count):
+        table_ids = np.arange(table_count)
+        projects = np.array(self.projects)[table_ids % len(self.projects)]
+        datasets = ['dataset_{}'.format(i) for i in self.random.randint(0, DATASETS_PER_PROJECT, table_count)]
+        # A fifth of the tables are date shards of the same table
+        sharded = self.random.rand(table_count) < 0.2
+        names = ['table_{}_20230{}{:02d}'.format(i // 30, i % 5 + 1, i % 28 + 1) if shard else 'table_{}'.format(i)
+                 for i, shard in zip(table_ids, sharded)]
+        ages = self.random.randint(1, 720, table_count)
+        return pd.DataFrame({
+            'project_id': projects,
+            'dataset_id': datasets,
+            'table_id': names,
+            'type': self.random.choice([1, 1, 1, 2, 3], table_count),
+            'creation_time': ((self.now - pd.to_timedelta(ages, unit='D')).astype('int64') // 10 ** 6),
+            'size_bytes': self.random.lognormal(20, 3, table_count).astype('int64'),
+        })
+
+    def _columns(self):
+        tables = self.tables.loc[self.tables.index.repeat(COLUMNS_PER_TABLE)]
+        return pd.DataFrame({
+            'table_catalog': tables.project_id.values,
+            'table_schema': tables.dataset_id.values,
+            'table_name': tables.table_id.values,
+            'column_name': ['column_{}'.format(i) for i in np.tile(np.arange(COLUMNS_PER_TABLE), len(self.tables))],
+        })
+
+    def _logs(self, template_count):
+        template_tables = self.tables.iloc[self.random.randint(0, len(self.tables), template_count)]
+        templates = []
+        for table in template_tables.itertuples():
+            columns = self.random.choice(COLUMNS_PER_TABLE, self.random.randint(1, 5), replace=False)
+            templates.append('SELECT {} FROM `{}.{}.{}` WHERE column_0 = {{}} AND column_1 > \'{{}}\''.format(
+                ', '.join('column_{}'.format(i) for i in columns), table.project_id, table.dataset_id,
+                table.table_id))
+
+        picks = self.random.randint(0, template_count, self.rows)
+        literals = self.random.randint(0, 1000, self.rows)
+        start_times = self.now - pd.to_timedelta(self.random.randint(0, 180 * 24 * 3600, self.rows), unit='s')
+        tables = template_tables.iloc[picks]
+        return pd.DataFrame({
+            'user_email': ['user_{}@example.com'.format(i) for i in self.random.randint(0, USERS, self.rows)],
+            'job_type': 'QUERY',
+            'last_run_date': start_times.normalize().date,
+            'project_id': tables.project_id.values,
+            'dataset_id': tables.dataset_id.values,
+            'table_id': tables.table_id.values,
+            'query': [templates[pick].format(literal, literal) for pick, literal in zip(picks, literals)],
+            'last_call': 1,
+            'next_watermark': start_times.max(),
+        })
+
+    def project_logs(self, project):
+        return self.logs[self.logs.project_id == project].reset_index(drop=True)
+
+    def datasets(self, project):
+        return sorted(self.tables[self.tables.project_id == project].dataset_id.unique())
+
+    def unused_tables(self, project, dataset=None):
+        # The result of the unused_tables query for a project (or a single dataset of it)
+        tables = self.tables[self.tables.project_id == project]
+        if dataset is not None:
+            tables = tables[tables.dataset_id == dataset]
+        size_gb = (tables.size_bytes / 10 ** 9).round()
+        return pd.DataFrame({
+            'project_id': tables.project_id.values,
+            'dataset_id': tables.dataset_id.values,
+            'table_id': tables.table_id.values,
+            'last_called_by': None,
+            'full_table': (tables.project_id + '.' + tables.dataset_id + '.' + tables.table_id).values,
+            'type': tables.type.map({1: 'table', 2: 'view', 3: 'External'}).values,
+            'creation_date': pd.to_datetime(tables.creation_time, unit='ms').dt.date.values,
+            'last_modified_date': pd.Timestamp('1980-01-11'),
+            'severity_groups': '6 months unused',
+            'size_gb': size_gb.values,
+            'monthly_cost': (size_gb * 0.02).round().values,
+            'annual_cost': (size_gb * 0.02).round().values * 12,
+        })
+
+    def dataset_signatures(self, datasets):
+        # The latest last_modified_time and the number of tables of (project, dataset) pairs, as __TABLES__ has them
+        rows = []
+        for project, dataset in datasets:
+            tables = self.tables[(self.tables.project_id == project) & (self.tables.dataset_id == dataset)]
+            rows.append((dataset, tables.creation_time.max() if len(tables) else None, len(tables)))
+        return pd.DataFrame(rows, columns=['dataset_id', 'last_modified_time', 'table_count'])
+
+    def dataset_columns(self, project, dataset=None):
+        # The columns of a project (or a single dataset of it), as INFORMATION_SCHEMA.COLUMNS has them
+        columns = self.columns[self.columns.table_catalog == project]
+        if dataset is not None:
+            columns = columns[columns.table_schema == dataset]
+        return columns.reset_index(drop=True)
+
+    def unused_columns(self, project, dataset=None):
+        # The result of the unused_columns query for a project (or a single dataset of it)
+        return self.unused_columns_of(self.dataset_columns(project, dataset))
+
+    @staticmethod
+    def unused_columns_of(columns):
+        return pd.DataFrame({
+            'table_name': (columns.table_catalog + '.' + columns.table_schema + '.' + columns.table_name).values,
+            'column_name': columns.column_name.values,
+            'last_run_date': pd.NaT,
+            'severity_group': 'more than 6',
+        })
@@ -0,0 +1,258 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file runs a query and downloads its result.
+Big results are streamed as Arrow record batches over several BigQuery Storage Read API streams in parallel, small
+results and results that can't use the Storage API (missing package or permissions) are paged through the REST API.
+Input:
+    1. A BQ client, a query and the project to run it in
+    2. The number of read streams to ask the Storage API for, set once with configure()
+Output: The result as a single DataFrame, or as a sequence of DataFrames processed as the batches arrive
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
+import threading
+import time
+import db_dtypes
+import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import budget
+import metrics
+
+# Below this many rows a read session costs more than paging through the REST API
+STORAGE_API_MIN_ROWS = 10000
+
+_read_streams = 4
+_use_storage_api = True
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def configure(read_streams=4, use_storage_api=True):
+    global _read_streams, _use_storage_api
+    _read_streams = read_streams
+    _use_storage_api = use_storage_api
+
+
+def _disable_storage_api(reason):
+    global _use_storage_api
+    if _use_storage_api:
+        print('BigQuery Storage API is not available, downloading results through the REST API: ', str(reason)[:200])
+    _use_storage_api = False
+
+
+def _get_storage_client():
+    global _storage_client
+    with _storage_client_lock:
+        if _use_storage_api and _storage_client is None:
+            try:
+                from google.cloud import bigquery_storage
+                _storage_client = bigquery_storage.BigQueryReadClient()
+            except Exception as exe:
+                _disable_storage_api(exe)
+        return _storage_client if _use_storage_api else None
+
+
+# Same null-safe dtypes RowIterator.to_dataframe() gives, so both download paths return identical frames
+def _types_mapper(arrow_type):
+    if pa.types.is_boolean(arrow_type):
+        return pd.BooleanDtype()
+    if pa.types.is_date(arrow_type):
+        return db_dtypes.DateDtype()
+    if pa.types.is_integer(arrow_type):
+        return pd.Int64Dtype()
+    if pa.types.is_time(arrow_type):
+        return db_dtypes.TimeDtype()
+    return None
+
+
+def arrow_to_dataframe(arrow_data, categories=None):
+    # Columns in categories (ids repeated over many rows) are dictionary encoded instead of holding a string per row
+    categories = [column for column in categories or [] if column in arrow_data.schema.names]
+    try:
+        return arrow_data.to_pandas(types_mapper=_types_mapper, categories=categories)
+    except pa.ArrowInvalid:
+        # Dates and timestamps out of the nanosecond range are kept as python objects
+        return arrow_data.to_pandas(date_as_object=True, timestamp_as_object=True, categories=categories,
+                                    types_mapper=lambda arrow_type: None if pa.types.is_date(arrow_type)
+                                    else _types_mapper(arrow_type))
+
+
+def to_categories(df, categories=None):
+    for column in categories or []:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def concat_frames(frames, categories=None):
+    # pd.concat turns categories that differ between the frames back into strings, so they are merged on their own
+    categories = [column for column in categories or [] if column in frames[0].columns]
+    df = pd.concat([frame.drop(columns=categories) for frame in frames], ignore_index=True)
+    for column in categories:
+        df[column] = union_categoricals([frame[column] for frame in frames], ignore_order=True)
+    return df[frames[0].columns]
+
+
+def _create_read_session(client, storage_client, table):
+    from google.cloud import bigquery_storage
+    requested_session = bigquery_storage.types.ReadSession(table=table.to_bqstorage(),
+                                                           data_format=bigquery_storage.types.DataFormat.ARROW)
+    return storage_client.create_read_session(parent='projects/{}'.format(client.project),
+                                              read_session=requested_session, max_stream_count=_read_streams)
+
+
+def _read_stream(storage_client, session, stream, batches, stop):
+    reader = storage_client.read_rows(stream.name)
+    for page in reader.rows(session).pages:
+        if stop.is_set():
+            return
+        batches.put(page.to_arrow())
+
+
+def _iter_session_batches(storage_client, session):
+    # The queue is bounded so the streams wait for the caller instead of piling up the whole result in memory
+    batches = queue.Queue(maxsize=len(session.streams) * 2)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(session.streams)) as executor:
+        futures = [executor.submit(_read_stream, storage_client, session, stream, batches, stop)
+                   for stream in session.streams]
+        try:
+            while futures or not batches.empty():
+                try:
+                    yield batches.get(timeout=0.1)
+                except queue.Empty:
+                    done, pending = wait(futures, timeout=0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                    futures = list(pending)
+        finally:
+            stop.set()
+            # Unblock streams that are waiting for room in the queue so they can see they should stop
+            while any(not future.done() for future in futures):
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+def _open_read_session(client, job, rows):
+    if job.destination is None or (rows.total_rows or 0) < STORAGE_API_MIN_ROWS:
+        return None, None
+    storage_client = _get_storage_client()
+    if storage_client is None:
+        return None, None
+    try:
+        session = _create_read_session(client, storage_client, job.destination)
+    except Exception as exe:
+        _disable_storage_api(exe)
+        return None, None
+    if not session.streams:
+        return None, None
+    return storage_client, session
+
+
+def _merge_chunks(items, chunk_rows, merge):
+    chunk = []
+    chunk_size = 0
+    for item in items:
+        chunk.append(item)
+        chunk_size += len(item)
+        if chunk_size >= chunk_rows:
+            yield merge(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield merge(chunk)
+
+
+def run_query(client, query, project=None):
+    # The job runs (and is billed) in project, or in the project of the client
+    max_bytes_billed = budget.reserve(client, query)
+    with metrics.span('query') as record:
+        job = client.query(query, job_config=budget.job_config(max_bytes_billed), project=project)
+        rows = job.result()
+        metrics.record_job(record, job)
+    budget.settle(client, query, job.total_bytes_billed)
+    return job, rows
+
+
+def _measure_frames(frames):
+    # Only the time spent waiting for the next frame is measured, not the time the caller spends on it
+    frames = iter(frames)
+    while True:
+        start = time.perf_counter()
+        df = next(frames, None)
+        if df is None:
+            return
+        metrics.add_span(metrics.new_span('download', len(df)), time.perf_counter() - start)
+        yield df
+
+
+def _iter_frames(client, job, rows, chunk_rows, categories):
+    storage_client, session = _open_read_session(client, job, rows)
+    if session is None:
+        frames = (to_categories(df, categories) for df in rows.to_dataframe_iterable())
+        if chunk_rows:
+            frames = _merge_chunks(frames, chunk_rows, lambda chunk: concat_frames(chunk, categories))
+        yield from frames
+        return
+
+    batches = _iter_session_batches(storage_client, session)
+    if chunk_rows:
+        batches = _merge_chunks(batches, chunk_rows, pa.Table.from_batches)
+    for batch in batches:
+        yield arrow_to_dataframe(batch, categories)
+
+
+def iter_query_frames(client, query, chunk_rows=None, categories=None):
+    # Batches are merged until they hold at least chunk_rows rows, so the caller gets a few big frames
+    # instead of many small ones
+    job, rows = run_query(client, query)
+    yield from _measure_frames(_iter_frames(client, job, rows, chunk_rows, categories))
+
+
+def query_dataframe(client, query, categories=None, project=None):
+    job, rows = run_query(client, query, project)
+    with metrics.span('download') as record:
+        storage_client, session = _open_read_session(client, job, rows)
+        if not categories:
+            if session is None:
+                df = rows.to_dataframe(create_bqstorage_client=False)
+            else:
+                df = arrow_to_dataframe(pa.Table.from_batches(list(_iter_session_batches(storage_client, session))))
+        else:
+            # Every page is encoded as soon as it arrives, so the whole result is never held as strings
+            if session is None:
+                frames = [to_categories(frame, categories) for frame in rows.to_dataframe_iterable()]
+            else:
+                frames = [arrow_to_dataframe(batch, categories)
+                          for batch in _iter_session_batches(storage_client, session)]
+            if frames:
+                df = concat_frames(frames, categories)
+            else:
+                df = to_categories(pd.DataFrame(columns=[field.name for field in rows.schema]), categories)
+        record['rows'] = len(df)
+    return df
@@ -0,0 +1,180 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file keeps a run within a budget of bytes billed.
+Every query is dry run first to estimate the bytes it will scan, and it only runs if its estimate still fits in what
+is left of the budget; BQ is also told to fail any job that would bill more than that. Once a job is done, the budget is
+charged the bytes it actually billed instead of its estimate. Before the queries of a check run, they are all dry run
+together and the plan is printed, and the units that don't fit are deferred to a later run.
+Input:
+    1. The budget of bytes billed of the run, set once with configure()
+    2. A BQ client and the queries about to run
+Output: The units that fit in the budget, or BudgetExceeded for a query that doesn't
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from google.cloud import bigquery
+
+# BQ bills every query at least 10 MB, however few bytes it scans
+MIN_BYTES_BILLED = 10 * 1024 * 1024
+
+_max_bytes_billed = None
+_bytes_reserved = 0
+_queries_deferred = 0
+_estimates = {}
+_lock = threading.Lock()
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def configure(max_bytes_billed=None):
+    global _max_bytes_billed, _bytes_reserved, _queries_deferred
+    _max_bytes_billed = max_bytes_billed
+    _bytes_reserved = 0
+    _queries_deferred = 0
+    _estimates.clear()
+
+
+def enabled():
+    return _max_bytes_billed is not None
+
+
+def remaining():
+    with _lock:
+        return _max_bytes_billed - _bytes_reserved
+
+
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1000:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1000
+    return '{:.1f} TB'.format(size)
+
+
+def estimate(client, query):
+    # Dry runs are free, but they are still only made once per query
+    if query not in _estimates:
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        size = client.query(query, job_config=job_config).total_bytes_processed or 0
+        _estimates[query] = max(size, MIN_BYTES_BILLED)
+    return _estimates[query]
+
+
+def reserve(client, query):
+    # Returns the most bytes the query may bill: what was left of the budget before it was reserved
+    global _bytes_reserved, _queries_deferred
+    if not enabled():
+        return None
+    size = estimate(client, query)
+    with _lock:
+        available = _max_bytes_billed - _bytes_reserved
+        if size > available:
+            _queries_deferred += 1
+            raise BudgetExceeded('The query would scan {} but only {} is left of the budget'.format(
+                format_bytes(size), format_bytes(available)))
+        _bytes_reserved += size
+    return available
+
+
+def settle(client, query, bytes_billed):
+    # Once the job is done the budget is charged what it billed instead of its estimate
+    global _bytes_reserved
+    if not enabled() or bytes_billed is None:
+        return
+    with _lock:
+        _bytes_reserved += bytes_billed - estimate(client, query)
+
+
+def job_config(max_bytes_billed=None):
+    if max_bytes_billed is None:
+        return None
+    # BQ fails the job instead of billing more than what was left for it, in case the estimate was too low
+    return bigquery.QueryJobConfig(maximum_bytes_billed=max(max_bytes_billed, 0))
+
+
+def deferred():
+    return _queries_deferred
+
+
+def plan(client, units, build_query, max_concurrent_jobs=1, stage=None):
+    global _queries_deferred
+    if not units:
+        return units
+    with ThreadPoolExecutor(max_workers=max(max_concurrent_jobs, 1)) as executor:
+        sizes = list(executor.map(lambda unit: _plan_estimate(client, build_query(unit)), units))
+
+    # Units are kept in their order as long as they fit, the ones that don't are left for a later run
+    available = remaining()
+    planned = []
+    deferred_units = []
+    for unit, size in zip(units, sizes):
+        if size <= available:
+            planned.append(unit)
+            available -= size
+        else:
+            deferred_units.append(unit)
+    print('Plan{}: {} queries scanning {}, {} of {} left in the budget'.format(
+        ' for {}'.format(stage) if stage else '', len(units), format_bytes(sum(sizes)),
+        format_bytes(remaining()), format_bytes(_max_bytes_billed)))
+    if deferred_units:
+        with _lock:
+            _queries_deferred += len(deferred_units)
+        print('Deferring {} queries that are over the budget: {}'.format(
+            len(deferred_units), ', '.join('.'.join(filter(None, unit)) for unit in deferred_units[:20])))
+    return planned
+
+
+def _plan_estimate(client, query):
+    try:
+        return estimate(client, query)
+    except Exception as exe:
+        # The query would fail the same way when it runs, it is reported then
+        return 0
+
+
+def write_billed(path):
+    # A process run by --workers leaves what it billed for the coordinator, which passes the rest to the next ones
+    if path is None or not enabled():
+        return
+    with open(path, 'w') as file:
+        file.write(str(_bytes_reserved))
+
+
+def read_billed(path):
+    try:
+        with open(path) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def report():
+    if not enabled():
+        return
+    print('Budget: {} of {} used{}'.format(
+        format_bytes(_bytes_reserved), format_bytes(_max_bytes_billed),
+        ', {} queries deferred'.format(_queries_deferred) if _queries_deferred else ''))
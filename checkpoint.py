@@ -0,0 +1,97 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file keeps track of the work a run already finished, in a local SQLite file, so a run that crashed can be resumed.
+Every unit of work (stage, project, dataset) that loaded is stored with its result, and every stage that finished is
+marked as done. A resumed run replays the stored results and only runs the units and stages that are missing.
+Input:
+    1. Path of the checkpoint file
+    2. Whether to resume from the file or start a new run
+Output: The stored result of a unit, or None when it has to run
+"""
+
+import pickle
+import sqlite3
+import threading
+
+_connection = None
+_lock = threading.Lock()
+
+
+def configure(path=None, resume=False):
+    global _connection
+    if path is None:
+        _connection = None
+        return
+    _connection = sqlite3.connect(path, check_same_thread=False)
+    with _lock:
+        _connection.execute('CREATE TABLE IF NOT EXISTS units '
+                            '(stage TEXT, project TEXT, dataset TEXT, result BLOB, PRIMARY KEY (stage, project, dataset))')
+        if not resume:
+            _connection.execute('DELETE FROM units')
+        _connection.commit()
+
+
+def load(stage, project, dataset=''):
+    if _connection is None or stage is None:
+        return None
+    with _lock:
+        row = _connection.execute('SELECT result FROM units WHERE stage = ? AND project = ? AND dataset = ?',
+                                  (stage, project, dataset or '')).fetchone()
+    if row is None:
+        return None
+    return pickle.loads(row[0])
+
+
+def has(stage, project, dataset=''):
+    if _connection is None or stage is None:
+        return False
+    with _lock:
+        row = _connection.execute('SELECT 1 FROM units WHERE stage = ? AND project = ? AND dataset = ?',
+                                  (stage, project, dataset or '')).fetchone()
+    return row is not None
+
+
+def save(stage, project, dataset, result):
+    if _connection is None or stage is None:
+        return
+    with _lock:
+        _connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?)',
+                            (stage, project, dataset or '', pickle.dumps(result)))
+        _connection.commit()
+
+
+def stage_done(stage):
+    return load(stage, '') is not None
+
+
+def mark_stage_done(stage):
+    save(stage, '', '', True)
+
+
+def clear():
+    if _connection is None:
+        return
+    with _lock:
+        _connection.execute('DELETE FROM units')
+        _connection.commit()
@@ -0,0 +1,299 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file runs the checks on a single machine, over Parquet snapshots of the BQ metadata, with an embedded SQLite engine.
+Nothing is queried in BQ, so the checks can be run again with other thresholds for free and without any GCP access.
+The snapshots are exported once from BQ with export_snapshots():
+    1. jobs.parquet - INFORMATION_SCHEMA.JOBS (user_email, job_type, start_time, query, referenced_tables)
+    2. tables.parquet - __TABLES__ of every dataset (project_id, dataset_id, table_id, type, creation_time, size_bytes)
+    3. columns.parquet - INFORMATION_SCHEMA.COLUMNS of every dataset (table_catalog, table_schema, table_name, column_name)
+Input:
+    1. The directory of the snapshots
+    2. The checks to run and the thresholds (in days) of the severity groups
+Output: Parquet files of total_logs, unused_tables, used_columns, unparsed_queries and unused_columns
+"""
+
+import datetime
+import os
+import re
+import sqlite3
+import pandas as pd
+import metadata_cache
+import metrics
+import query_dispatch
+import table_writer
+import used_columns
+
+# A table created and only called on the same day is 'never used' once it is this old
+NEVER_USED_DAYS = 30
+
+# Price of a GB of active storage per month, in USD
+STORAGE_PRICE = 0.02
+
+JOBS_SNAPSHOT = 'jobs.parquet'
+TABLES_SNAPSHOT = 'tables.parquet'
+COLUMNS_SNAPSHOT = 'columns.parquet'
+
+TOTAL_LOGS_QUERY = """
+    SELECT user_email, job_type, last_run_date, project_id, dataset_id, table_id, query, last_call
+    FROM (
+        SELECT  user_email,
+                job_type,
+                date(start_time) || ' 00:00:00' AS last_run_date,
+                project_id,
+                dataset_id,
+                table_id,
+                query,
+                ROW_NUMBER() OVER (PARTITION BY project_id, dataset_id, table_id ORDER BY date(start_time) DESC) AS last_call
+        FROM job_tables
+        WHERE query IS NOT NULL
+        )
+    WHERE last_call = 1
+"""
+
+UNUSED_TABLES_QUERY = """
+    WITH calculate_last_call AS (
+        SELECT *
+        FROM (
+            SELECT  *,
+                    ROW_NUMBER() OVER (PARTITION BY table_id, dataset_id, project_id ORDER BY last_run_date DESC) AS table_last_call
+            FROM total_logs
+            )
+        WHERE table_last_call = 1
+    ),
+
+    tables_last_call AS (
+        SELECT
+            project_id,
+            dataset_id,
+            table_id,
+            user_email AS last_called_by,
+            project_id || '.' || dataset_id || '.' || table_id AS full_table,
+            CASE
+                WHEN type = 1 THEN 'table'
+                WHEN type = 2 THEN 'view'
+                WHEN type = 3 THEN 'External'
+                ELSE NULL
+            END AS type,
+            date(creation_time / 1000, 'unixepoch') AS creation_date,
+            COALESCE(last_run_date, '1980-01-11') AS last_modified_date,
+            date(last_run_date) AS last_run_day,
+            size_bytes
+        FROM tables LEFT JOIN calculate_last_call USING (project_id, dataset_id, table_id)
+    )
+
+    SELECT
+        project_id,
+        dataset_id,
+        table_id,
+        last_called_by,
+        full_table,
+        type,
+        creation_date,
+        last_modified_date,
+        CASE
+            WHEN last_run_day = creation_date
+                AND last_run_day < date(:as_of, '-' || :never_used_days || ' day') THEN 'never used'
+            WHEN last_run_day IS NULL
+                AND creation_date <= date(:as_of, '-' || :unused_days || ' day') THEN '6 months unused'
+            WHEN last_run_day < date(:as_of, '-' || :stale_days || ' day')
+                AND last_run_day >= date(:as_of, '-' || :unused_days || ' day') THEN '3 months unused'
+            ELSE NULL
+        END AS severity_groups,
+        ROUND(SUM(size_bytes) / 1e9, 0) AS size_gb,
+        ROUND((SUM(size_bytes) / 1e9) * :storage_price) AS monthly_cost,
+        ROUND((SUM(size_bytes) / 1e9) * (1 - :discount) * :storage_price) * 12 AS annual_cost
+    FROM tables_last_call
+    GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9
+    HAVING severity_groups IS NOT NULL
+"""
+
+UNUSED_COLUMNS_QUERY = """
+    WITH used AS (
+        SELECT
+            project_id || '.' || dataset_id || '.' || table_id AS table_name,
+            project_id,
+            dataset_id,
+            table_id,
+            column_name,
+            MAX(date(last_run_date)) AS last_run_date
+        FROM used_columns
+        GROUP BY 1, 2, 3, 4, 5
+    ),
+
+    all_columns AS (
+        SELECT
+            DISTINCT table_catalog || '.' || table_schema || '.' || table_name AS table_name,
+            table_catalog AS project_id,
+            table_schema AS dataset_id,
+            REGEXP_REPLACE(table_name, '\\_\\d{8}', '') AS table_id,
+            column_name
+        FROM columns
+    ),
+
+    unused_columns_wd AS (
+        SELECT
+            DISTINCT all_columns.project_id,
+            all_columns.dataset_id,
+            all_columns.table_id,
+            all_columns.table_name,
+            all_columns.column_name,
+            used.last_run_date,
+            CASE
+                WHEN used.column_name IS NULL THEN 'more than 6'
+                WHEN used.last_run_date < date(:as_of, '-' || :stale_days || ' day') THEN 'bet.3 and 6 m'
+                ELSE 'used in last 3 m'
+            END AS severity_group
+        FROM all_columns LEFT JOIN used USING (column_name, table_id)
+    ),
+
+    unused_columns AS (
+        SELECT *
+        FROM (
+            SELECT  *,
+                    ROW_NUMBER() OVER (PARTITION BY table_name, column_name ORDER BY last_run_date DESC) AS last_
+            FROM unused_columns_wd
+            WHERE severity_group <> 'used in last 3 m'
+            )
+        WHERE last_ = 1
+    )
+
+    SELECT DISTINCT
+        REGEXP_REPLACE(table_name, '\\_\\d{8}', '') AS table_name,
+        column_name,
+        last_run_date,
+        severity_group
+    FROM unused_columns
+"""
+
+
+def _regexp_replace(value, pattern, replacement):
+    if value is None:
+        return None
+    return re.sub(pattern, replacement, value)
+
+
+def connect():
+    connection = sqlite3.connect(':memory:')
+    connection.create_function('REGEXP_REPLACE', 3, _regexp_replace, deterministic=True)
+    return connection
+
+
+def export_snapshots(client, snapshot_dir, max_concurrent_jobs=1):
+    jobs_query = """
+            SELECT user_email, job_type, start_time, query, referenced_tables
+            FROM `{}.`.`region-us`.INFORMATION_SCHEMA.JOBS
+            WHERE query IS NOT NULL
+    """
+    tables_query = """
+            SELECT project_id, dataset_id, table_id, type, creation_time, size_bytes
+            FROM `{}.{}.`.__TABLES__
+    """
+    columns_query = """
+            SELECT table_catalog, table_schema, table_name, column_name
+            FROM `{}.{}`.INFORMATION_SCHEMA.COLUMNS
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    projects = metadata_cache.list_projects(client)
+    units = [(project, dataset.dataset_id)
+             for project, datasets in query_dispatch.list_datasets(client, projects, max_concurrent_jobs)
+             for dataset in datasets]
+
+    # The jobs of every project run in that project, like the ones of total_logs
+    jobs = [df for unit, df in query_dispatch.iter_results(client, [(project, '') for project in projects],
+                                                           lambda unit: jobs_query.format(unit[0]),
+                                                           max_concurrent_jobs, run_in_project=True)]
+    tables = [df for unit, df in query_dispatch.iter_results(client, units, lambda unit: tables_query.format(*unit),
+                                                             max_concurrent_jobs)]
+    columns = [df for unit, df in query_dispatch.iter_results(client, units, lambda unit: columns_query.format(*unit),
+                                                              max_concurrent_jobs)]
+    for name, dfs in ((JOBS_SNAPSHOT, jobs), (TABLES_SNAPSHOT, tables), (COLUMNS_SNAPSHOT, columns)):
+        if dfs:
+            pd.concat(dfs, ignore_index=True).to_parquet(os.path.join(snapshot_dir, name), index=False)
+    print('Exported snapshots to {}'.format(snapshot_dir))
+
+
+def job_tables(jobs_df):
+    # One row per table a job referenced, like unnest(referenced_tables) in BQ
+    jobs_df = jobs_df.explode('referenced_tables').dropna(subset=['referenced_tables'])
+    referenced_df = pd.DataFrame(list(jobs_df.pop('referenced_tables')), index=jobs_df.index,
+                                 columns=['project_id', 'dataset_id', 'table_id'])
+    jobs_df = jobs_df.join(referenced_df)
+    jobs_df['start_time'] = pd.to_datetime(jobs_df['start_time'], utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
+    return jobs_df
+
+
+def read_sql(connection, query, **params):
+    return pd.read_sql_query(query, connection, params=params)
+
+
+def run_checks(snapshot_dir, output_dir, queries, discount=0, parse_cache=None, pool=None, stale_days=90,
+               unused_days=180, as_of=None):
+    params = {'as_of': (as_of or datetime.date.today()).isoformat(), 'never_used_days': NEVER_USED_DAYS,
+              'stale_days': stale_days, 'unused_days': unused_days, 'storage_price': STORAGE_PRICE,
+              'discount': float(discount)}
+    os.makedirs(output_dir, exist_ok=True)
+
+    def write_output(name, df):
+        table_writer.decategorize(df).to_parquet(os.path.join(output_dir, '{}.parquet'.format(name)), index=False)
+
+    connection = connect()
+    try:
+        jobs_df = pd.read_parquet(os.path.join(snapshot_dir, JOBS_SNAPSHOT))
+        job_tables(jobs_df).to_sql('job_tables', connection, index=False)
+        total_logs_df = read_sql(connection, TOTAL_LOGS_QUERY)
+        total_logs_df.to_sql('total_logs', connection, index=False)
+        total_logs_df.last_run_date = total_logs_df.last_run_date.astype('datetime64[ns]')
+        write_output('total_logs', total_logs_df)
+        print('Finished total logs')
+
+        if "unused_tables" in queries:
+            pd.read_parquet(os.path.join(snapshot_dir, TABLES_SNAPSHOT)).to_sql('tables', connection, index=False)
+            unused_tables_df = read_sql(connection, UNUSED_TABLES_QUERY, **params)
+            unused_tables_df.creation_date = pd.to_datetime(unused_tables_df.creation_date).dt.date
+            unused_tables_df.last_modified_date = unused_tables_df.last_modified_date.astype('datetime64[ns]')
+            write_output('unused_tables', unused_tables_df)
+            print('Finished unused tables')
+
+        if "unused_columns" in queries:
+            # The columns are parsed out of the queries the same way as in BQ runs
+            with metrics.context('used_columns'):
+                used_columns_df, unparsed_queries_df = used_columns.extract_used_columns(total_logs_df, parse_cache,
+                                                                                         pool)
+            write_output('used_columns', used_columns_df)
+            write_output('unparsed_queries', unparsed_queries_df)
+            print('Finished used columns')
+
+            used_columns_df.assign(last_run_date=used_columns_df.last_run_date.dt.strftime('%Y-%m-%d %H:%M:%S')) \
+                .to_sql('used_columns', connection, index=False)
+            pd.read_parquet(os.path.join(snapshot_dir, COLUMNS_SNAPSHOT)).to_sql('columns', connection, index=False)
+            unused_columns_df = read_sql(connection, UNUSED_COLUMNS_QUERY, **params)
+            unused_columns_df.last_run_date = unused_columns_df.last_run_date.astype('datetime64[ns]')
+            write_output('unused_columns', unused_columns_df)
+            print('Finished unused columns')
+    finally:
+        connection.close()
+
+
+def main(snapshot_dir, output_dir, queries, discount=0, parse_cache=None, pool=None, stale_days=90, unused_days=180):
+    run_checks(snapshot_dir, output_dir, queries, discount, parse_cache, pool, stale_days, unused_days)
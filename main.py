@@ -26,43 +26,415 @@ import unused_columns
 import unused_tables
 import total_logs
 import used_columns
+import parse_cache
+import parse_pool
+import bq_read
+import budget
+import checkpoint
+import local_engine
+import metadata_cache
+import metrics
+import sharding
+import table_writer
 import os
+import shutil
+import subprocess
+import tempfile
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
 import sys
 
+STAGES = ['total_logs', 'unused_tables', 'used_columns', 'unused_columns']
 
-def credential_initialize(project_name, credential_path):
+# The stages whose output a stage reads
+STAGE_INPUTS = {'unused_tables': ['total_logs'], 'used_columns': ['total_logs'], 'unused_columns': ['used_columns']}
+
+# Connections the shared client keeps open, the default of requests
+HTTP_POOL_SIZE = 10
+
+
+def credential_initialize(project_name, credential_path, max_concurrent_jobs=1):
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credential_path
-    client = bigquery.Client(project=project_name)
+    # A single client is shared by every query of the run, its pool keeps a connection open for every job that may
+    # run at the same time instead of opening a new one for each request
+    credentials, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    pool_size = max(HTTP_POOL_SIZE, max_concurrent_jobs + 1)
+    session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    client = bigquery.Client(project=project_name, credentials=credentials, _http=session)
     return client, project_name
 
 
-def main(project_name, credential_path, queries, discount):
+def main(project_name, credential_path, queries, discount, max_concurrent_jobs=1, parse_cache_size=100000,
+         parse_cache_path=None, parse_workers=1, parse_timeout=60, full_refresh=False, metadata_scope='region',
+         read_streams=4, stream_results=False, upload_chunk_rows=500000, upload_max_memory_mb=1024,
+         checkpoint_path=None, resume=False, backend='bigquery', snapshot_dir=None, output_dir='data_defender_output',
+         stale_days=90, unused_days=180, metrics_path=None, prometheus_path=None, top_slowest=10,
+         max_bytes_billed=None, shard_index=None, shard_count=1, shard_stages=None, merge_shards=False,
+         metadata_cache_path=None, metadata_cache_ttl=24, bytes_billed_path=None):
+    if backend == 'local':
+        try:
+            run_local(snapshot_dir, output_dir, queries, discount, parse_cache_size, parse_cache_path, parse_workers,
+                      parse_timeout, stale_days, unused_days)
+        finally:
+            metrics.report(metrics_path, prometheus_path, top_slowest)
+        return
+
     try:
-        client, project_name = credential_initialize(project_name, credential_path)
+        client, project_name = credential_initialize(project_name, credential_path, max_concurrent_jobs)
     except Exception as exe:
         print("Could not set up credentials environment:\n")
         print(exe)
         exit(0)
 
-    total_logs.main(client, project_name)
+    stages = query_stages(queries)
+    if shard_stages:
+        stages = [stage for stage in stages if stage in shard_stages]
+    sharding.configure(shard_index, shard_count)
+    metrics_labels = None
+    if shard_stages:
+        metrics_path = sharding.stage_path(metrics_path, shard_stages)
+        prometheus_path = sharding.stage_path(prometheus_path, shard_stages)
+        metrics_labels = {'phase': '-'.join(shard_stages)}
+        if merge_shards or shard_index is not None:
+            metrics_labels['shard'] = 'merge' if merge_shards else str(shard_index)
+    if sharding.enabled():
+        # A worker keeps its own local files, its budget is the share it was given
+        checkpoint_path = sharding.shard_path(checkpoint_path)
+        parse_cache_path = sharding.shard_path(parse_cache_path)
+        metrics_path = sharding.shard_path(metrics_path)
+        prometheus_path = sharding.shard_path(prometheus_path)
+        metadata_cache_path = sharding.shard_path(metadata_cache_path)
+
+    bq_read.configure(read_streams)
+    table_writer.configure(upload_chunk_rows, upload_max_memory_mb)
+    checkpoint.configure(checkpoint_path, resume)
+    budget.configure(max_bytes_billed)
+    metadata_cache.configure(metadata_cache_path, metadata_cache_ttl)
+    try:
+        if snapshot_dir and not sharding.enabled() and 'total_logs' in stages:
+            run_stage('snapshots', lambda: local_engine.export_snapshots(client, snapshot_dir, max_concurrent_jobs))
+
+        if merge_shards:
+            run_merges(client, project_name, stages, shard_count, full_refresh)
+        else:
+            run_stages(client, project_name, stages, discount, max_concurrent_jobs, parse_cache_size,
+                       parse_cache_path, parse_workers, parse_timeout, full_refresh, metadata_scope, stream_results)
+
+        if budget.deferred():
+            print("Some queries were deferred to stay within the budget, run again with --resume to run them")
+        elif not shard_stages:
+            # The run is complete, the next one starts from scratch; the checkpoints of workers and merges are only
+            # cleared once the last phase merged, a later phase may still fail and be resumed
+            checkpoint.clear()
+    finally:
+        # Reported even when the run fails, that is when it is needed the most
+        metrics.report(metrics_path, prometheus_path, top_slowest, metrics_labels)
+        budget.report()
+        budget.write_billed(bytes_billed_path)
+        metadata_cache.report()
+
+
+def run_local(snapshot_dir, output_dir, queries, discount, parse_cache_size, parse_cache_path, parse_workers,
+              parse_timeout, stale_days, unused_days):
+    print("Running %s locally over the snapshots in %s" % (', '.join(queries), snapshot_dir))
+    cache = parse_cache.ParseCache(parse_cache_size, parse_cache_path)
+    pool = parse_pool.ParsePool(parse_workers, parse_timeout)
+    try:
+        local_engine.main(snapshot_dir, output_dir, queries, discount, cache, pool, stale_days, unused_days)
+    finally:
+        pool.close()
+        cache.close()
+
+
+def query_stages(queries):
+    stages = ['total_logs']
     if "unused_tables" in queries:
-        print("Running unused tables check for %s" % project_name)
-        unused_tables.main(client, project_name, discount)
+        stages.append('unused_tables')
     if "unused_columns" in queries:
+        stages += ['used_columns', 'unused_columns']
+    return stages
+
+
+def run_stages(client, project_name, stages, discount, max_concurrent_jobs, parse_cache_size, parse_cache_path,
+               parse_workers, parse_timeout, full_refresh, metadata_scope, stream_results):
+    # A stage that deferred queries left its output incomplete, the stages reading it wait for --resume and their
+    # previous output stays in place
+    incomplete = set()
+
+    def ready(stage):
+        if stage not in stages:
+            return False
+        waiting = [input_stage for input_stage in STAGE_INPUTS.get(stage, []) if input_stage in incomplete]
+        if waiting:
+            print("Skipping %s until the deferred queries of %s run" % (stage, ', '.join(waiting)))
+            incomplete.add(stage)
+            return False
+        return True
+
+    def run(stage, stage_run):
+        if not run_stage(stage, stage_run):
+            incomplete.add(stage)
+
+    if ready('total_logs'):
+        run('total_logs', lambda: total_logs.main(client, project_name, full_refresh, max_concurrent_jobs))
+    if ready('unused_tables'):
+        print("Running unused tables check for %s" % project_name)
+        run('unused_tables', lambda: unused_tables.main(client, project_name, discount, max_concurrent_jobs,
+                                                        metadata_scope))
+    if ready('used_columns'):
         print("Running unused columns check for %s" % project_name)
-        used_columns.main(client, project_name)
-        unused_columns.main(client, project_name)
+        cache = parse_cache.ParseCache(parse_cache_size, parse_cache_path)
+        # The parse workers are started before the logs are downloaded
+        pool = parse_pool.ParsePool(parse_workers, parse_timeout)
+        try:
+            run('used_columns', lambda: used_columns.main(client, project_name, cache, pool, full_refresh,
+                                                          stream_results))
+        finally:
+            pool.close()
+            cache.close()
+    if ready('unused_columns'):
+        run('unused_columns', lambda: unused_columns.main(client, project_name, max_concurrent_jobs,
+                                                          metadata_scope))
+
+
+def run_merges(client, project_name, stages, shard_count, full_refresh):
+    if 'total_logs' in stages:
+        run_stage('merge_total_logs', lambda: total_logs.merge_shards(client, project_name, shard_count,
+                                                                      full_refresh))
+    if 'unused_tables' in stages:
+        run_stage('merge_unused_tables', lambda: unused_tables.merge_shards(client, project_name, shard_count))
+    if 'used_columns' in stages:
+        run_stage('merge_used_columns', lambda: used_columns.merge_shards(client, project_name, shard_count,
+                                                                          full_refresh))
+    if 'unused_columns' in stages:
+        run_stage('merge_unused_columns', lambda: unused_columns.merge_shards(client, project_name, shard_count))
+
+
+def shard_phases(stages):
+    # Every phase reads the merged output of the phases before it, the stages of a phase only read older output
+    phases = [['total_logs'], ['used_columns'], ['unused_tables', 'unused_columns']]
+    return [[stage for stage in phase if stage in stages] for phase in phases
+            if any(stage in stages for stage in phase)]
+
+
+def run_workers(argv, workers, phases, checkpoint_path, resume=False, max_bytes_billed=None):
+    # The workers get the same options, the ones added at the end take precedence. They always resume: a new run
+    # clears their checkpoints here once, so a later phase doesn't clear what the earlier ones recorded
+    if not resume:
+        clear_checkpoints(checkpoint_path, workers)
+    command = [sys.executable, os.path.abspath(__file__)] + argv + ['--workers', '1', '--shard-count', str(workers),
+                                                                    '--resume']
+    # Every process gets its share of what the ones before it left of the budget, and reports what it billed
+    billed_dir = tempfile.mkdtemp(prefix='data_defender_billed_') if max_bytes_billed is not None else None
+    try:
+        for phase in phases:
+            print("Running %s in %d workers" % (', '.join(phase), workers))
+            billed_paths = [billed_path(billed_dir, shard) for shard in range(workers)]
+            processes = [subprocess.Popen(command + ['--shard-index', str(shard), '--shard-stage'] + phase +
+                                          budget_args(max_bytes_billed, workers, billed_paths[shard]))
+                         for shard in range(workers)]
+            failed = [str(shard) for shard, process in enumerate(processes) if process.wait() != 0]
+            max_bytes_billed = spend(max_bytes_billed, billed_paths)
+            if failed:
+                print("Shards %s of %s failed, run again with --resume to retry them" % (', '.join(failed),
+                                                                                         ', '.join(phase)))
+                sys.exit(1)
+            # Merging shards that deferred queries would replace the outputs with part of the rows, and the next
+            # phases would read them; all of it waits for --resume
+            if not workers_done(checkpoint_path, workers, phase):
+                print("Some queries were deferred to stay within the budget, run again with --resume to run them")
+                return
+            merge_billed_path = billed_path(billed_dir, 'merge')
+            merged = subprocess.call(command + ['--merge-shards', '--shard-stage'] + phase +
+                                     budget_args(max_bytes_billed, 1, merge_billed_path)) == 0
+            max_bytes_billed = spend(max_bytes_billed, [merge_billed_path])
+            if not merged:
+                print("Could not merge the shards of %s" % ', '.join(phase))
+                sys.exit(1)
+    finally:
+        if billed_dir is not None:
+            shutil.rmtree(billed_dir, ignore_errors=True)
+
+    # Workers that deferred queries did not mark their stage done, those are run again on resume
+    if phases_done(checkpoint_path, workers, phases):
+        clear_checkpoints(checkpoint_path, workers)
+    else:
+        print("Some queries were deferred to stay within the budget, run again with --resume to run them")
+
+
+def billed_path(billed_dir, name):
+    if billed_dir is None:
+        return None
+    return os.path.join(billed_dir, '{}.txt'.format(name))
+
+
+def budget_args(max_bytes_billed, shares, path):
+    if max_bytes_billed is None:
+        return []
+    return ['--max-bytes-billed', str(max(max_bytes_billed, 0) // shares), '--bytes-billed-path', path]
+
+
+def spend(max_bytes_billed, paths):
+    if max_bytes_billed is None:
+        return None
+    for path in paths:
+        max_bytes_billed -= budget.read_billed(path)
+        # The next process of the phase or of a later one doesn't read a file left by an earlier one
+        if os.path.exists(path):
+            os.remove(path)
+    return max_bytes_billed
+
+
+def checkpoint_paths(checkpoint_path, workers):
+    return [checkpoint_path] + [sharding.shard_path(checkpoint_path, shard) for shard in range(workers)]
+
+
+def clear_checkpoints(checkpoint_path, workers):
+    if checkpoint_path is None:
+        return
+    for path in checkpoint_paths(checkpoint_path, workers):
+        checkpoint.configure(path, resume=False)
+    checkpoint.configure(None)
+
+
+def phases_done(checkpoint_path, workers, phases):
+    if checkpoint_path is None:
+        return True
+    stages = [stage for phase in phases for stage in phase]
+    done = True
+    for shard, path in enumerate(checkpoint_paths(checkpoint_path, workers)):
+        checkpoint.configure(path, resume=True)
+        # The merges record their stages in the checkpoint of the coordinator, the workers in their own
+        done = done and all(checkpoint.stage_done('merge_' + stage if shard == 0 else stage) for stage in stages)
+    checkpoint.configure(None)
+    return done
+
+
+def workers_done(checkpoint_path, workers, stages):
+    if checkpoint_path is None:
+        return True
+    done = True
+    for shard in range(workers):
+        checkpoint.configure(sharding.shard_path(checkpoint_path, shard), resume=True)
+        done = done and all(checkpoint.stage_done(stage) for stage in stages)
+    checkpoint.configure(None)
+    return done
+
+
+def run_stage(stage, run):
+    if checkpoint.stage_done(stage):
+        print("Skipping %s, it already finished in the run being resumed" % stage)
+        return True
+    deferred = budget.deferred()
+    with metrics.context(stage):
+        run()
+    # A stage that deferred queries runs again on resume, only for the units that are missing
+    if budget.deferred() > deferred:
+        return False
+    checkpoint.mark_stage_done(stage)
+    return True
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Analyse BigQuery tables for usage")
-    parser.add_argument("--project_name", required=True, help="Name of the BigQuery project to use")
-    parser.add_argument("--credential_path", required=True,
-                        help="Path to the JSON credentials file used to access BigQuery")
+    parser.add_argument("--project_name", help="Name of the BigQuery project to use")
+    parser.add_argument("--credential_path", help="Path to the JSON credentials file used to access BigQuery")
     parser.add_argument('--query', required=True, nargs='+',
                         help="Which queries to run, valid values are 'unused_tables' and 'unused_columns'")
     parser.add_argument("--discount", default=0, help="A decimal representation of any discount, if applicable, for BigQuery")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=1,
+                        help="How many per-project or per-dataset BigQuery jobs may run at the same time, "
+                             "1 runs them one by one")
+    parser.add_argument("--parse-cache-size", type=int, default=100000,
+                        help="How many parsed queries to keep in memory while extracting the used columns")
+    parser.add_argument("--parse-cache-path", default=None,
+                        help="Path of a local file that keeps parsed queries between runs, disabled by default")
+    parser.add_argument("--parse-workers", type=int, default=1,
+                        help="How many processes parse queries while extracting the used columns")
+    parser.add_argument("--parse-timeout", type=float, default=60,
+                        help="Seconds a single query may take to parse before it is recorded as unparsed")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="Rescan all the jobs and reparse all the logs instead of only the ones since the previous run")
+    parser.add_argument("--metadata-scope", choices=['region', 'dataset'], default='region',
+                        help="Read table and column metadata with one query per project and region, or one per dataset")
+    parser.add_argument("--read-streams", type=int, default=4,
+                        help="How many BigQuery Storage API streams to download big query results with")
+    parser.add_argument("--stream-results", action="store_true",
+                        help="Parse the logs chunk by chunk as they are downloaded instead of loading them all first")
+    parser.add_argument("--upload-chunk-rows", type=int, default=500000,
+                        help="Most rows uploaded to BigQuery in a single load job")
+    parser.add_argument("--upload-max-memory-mb", type=int, default=1024,
+                        help="Most memory, in MB, the rows waiting to be uploaded to BigQuery may take")
+    parser.add_argument("--checkpoint-path", default="data_defender_checkpoint.sqlite",
+                        help="Path of a local file that records the finished work of a run so it can be resumed")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the previous run from the checkpoint file, only redoing unfinished work")
+    parser.add_argument("--backend", choices=['bigquery', 'local'], default='bigquery',
+                        help="Run the checks in BigQuery, or locally over the snapshots in --snapshot-dir")
+    parser.add_argument("--snapshot-dir", default=None,
+                        help="Directory of the Parquet metadata snapshots, exported there when running in BigQuery")
+    parser.add_argument("--output-dir", default="data_defender_output",
+                        help="Directory the local backend writes its output tables to, as Parquet files")
+    parser.add_argument("--stale-days", type=int, default=90,
+                        help="Days without a call after which the local backend reports a table or column as unused")
+    parser.add_argument("--unused-days", type=int, default=180,
+                        help="Days without a call after which the local backend reports a table as long unused")
+    parser.add_argument("--metrics-path", default=None,
+                        help="Path of a JSON file to write the time, rows and bytes of every step of the run to")
+    parser.add_argument("--prometheus-path", default=None,
+                        help="Path of a Prometheus textfile to write the totals of every stage to")
+    parser.add_argument("--top-slowest", type=int, default=10,
+                        help="How many of the slowest datasets to list at the end of the run")
+    parser.add_argument("--max-bytes-billed", type=int, default=None,
+                        help="Most bytes the queries of the run may bill, queries over the budget are deferred")
+    parser.add_argument("--bytes-billed-path", default=None,
+                        help="Path of a file to write the bytes the queries of the run billed to")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="How many worker processes to split the projects and datasets of every stage between")
+    parser.add_argument("--shard-count", type=int, default=1,
+                        help="How many workers the projects and datasets of a stage are split between")
+    parser.add_argument("--shard-index", type=int, default=None,
+                        help="Which of the --shard-count workers this run is, from 0")
+    parser.add_argument("--shard-stage", nargs='+', choices=STAGES, default=None,
+                        help="Which stages a worker or a merge of shards runs")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="Merge the output of the --shard-count workers of --shard-stage into the output tables")
+    parser.add_argument("--metadata-cache-path", default=None,
+                        help="Path of a local file that keeps project, dataset and column metadata between runs")
+    parser.add_argument("--metadata-cache-ttl", type=float, default=24,
+                        help="Hours the cached metadata is used for before it is read from BigQuery again")
     args = parser.parse_args()
+    if args.backend == 'bigquery' and not (args.project_name and args.credential_path):
+        parser.error("--project_name and --credential_path are required when running in BigQuery")
+    if args.backend == 'local' and not args.snapshot_dir:
+        parser.error("--snapshot-dir is required when running locally")
+    if args.backend == 'local' and (args.workers > 1 or args.shard_index is not None or args.merge_shards):
+        parser.error("--workers, --shard-index and --merge-shards are only supported when running in BigQuery")
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    if (args.shard_index is not None or args.merge_shards) and not args.shard_stage:
+        parser.error("--shard-stage is required with --shard-index and --merge-shards")
+    if args.shard_index is not None and args.merge_shards:
+        parser.error("--shard-index and --merge-shards can't be used together")
+
+    if args.workers > 1:
+        run_workers(sys.argv[1:], args.workers, shard_phases(query_stages(args.query)), args.checkpoint_path,
+                    args.resume, args.max_bytes_billed)
+        sys.exit(0)
 
-    main(args.project_name, args.credential_path, args.query, args.discount)
+    main(args.project_name, args.credential_path, args.query, args.discount,
+         max_concurrent_jobs=args.max_concurrent_jobs, parse_cache_size=args.parse_cache_size,
+         parse_cache_path=args.parse_cache_path, parse_workers=args.parse_workers, parse_timeout=args.parse_timeout,
+         full_refresh=args.full_refresh, metadata_scope=args.metadata_scope, read_streams=args.read_streams,
+         stream_results=args.stream_results, upload_chunk_rows=args.upload_chunk_rows,
+         upload_max_memory_mb=args.upload_max_memory_mb, checkpoint_path=args.checkpoint_path, resume=args.resume,
+         backend=args.backend, snapshot_dir=args.snapshot_dir, output_dir=args.output_dir,
+         stale_days=args.stale_days, unused_days=args.unused_days, metrics_path=args.metrics_path,
+         prometheus_path=args.prometheus_path, top_slowest=args.top_slowest,
+         max_bytes_billed=args.max_bytes_billed, shard_index=args.shard_index, shard_count=args.shard_count,
+         shard_stages=args.shard_stage, merge_shards=args.merge_shards,
+         metadata_cache_path=args.metadata_cache_path, metadata_cache_ttl=args.metadata_cache_ttl,
+         bytes_billed_path=args.bytes_billed_path)
@@ -0,0 +1,190 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file keeps the metadata that rarely changes between runs in a local SQLite file: the list of projects, the
+datasets of every project and the tables and columns of every dataset.
+Project and dataset lists are listed again once they are older than the TTL. The columns of a dataset are read again
+once they are older than the TTL or when the tables of the dataset changed since they were read: the latest
+last_modified_time and the number of its tables in __TABLES__, read for many datasets of a project in one query.
+Without a cache file everything is listed and read again on every run, like before.
+Input:
+    1. Path of the cache file and the TTL, set once with configure()
+    2. A BQ client
+Output: Project ids, dataset list items and the columns of a dataset, from the cache when they are still valid
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+import sqlite3
+import threading
+import time
+from google.cloud.bigquery.dataset import DatasetListItem
+import bq_read
+import metrics
+
+_connection = None
+_ttl_seconds = 0
+_hits = 0
+_misses = 0
+_lock = threading.Lock()
+
+# Datasets whose tables are checked in a single query
+DATASETS_PER_QUERY = 200
+
+
+def configure(path=None, ttl_hours=24):
+    global _connection, _ttl_seconds, _hits, _misses
+    _ttl_seconds = ttl_hours * 3600
+    _hits = 0
+    _misses = 0
+    if path is None:
+        _connection = None
+        return
+    _connection = sqlite3.connect(path, check_same_thread=False)
+    with _lock:
+        _connection.execute('CREATE TABLE IF NOT EXISTS listings '
+                            '(kind TEXT, project TEXT, fetched_at REAL, result BLOB, PRIMARY KEY (kind, project))')
+        _connection.execute('CREATE TABLE IF NOT EXISTS columns (project TEXT, dataset TEXT, modified TEXT, '
+                            'fetched_at REAL, result BLOB, PRIMARY KEY (project, dataset))')
+        _connection.commit()
+
+
+def enabled():
+    return _connection is not None
+
+
+def _count(hit):
+    global _hits, _misses
+    with _lock:
+        if hit:
+            _hits += 1
+        else:
+            _misses += 1
+
+
+def _fresh(fetched_at):
+    return time.time() - fetched_at < _ttl_seconds
+
+
+def _cached_listing(kind, project, fetch):
+    if _connection is None:
+        return fetch()
+    with _lock:
+        row = _connection.execute('SELECT fetched_at, result FROM listings WHERE kind = ? AND project = ?',
+                                  (kind, project)).fetchone()
+    if row is not None and _fresh(row[0]):
+        _count(True)
+        return pickle.loads(row[1])
+    _count(False)
+    result = fetch()
+    with _lock:
+        _connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                            (kind, project, time.time(), pickle.dumps(result)))
+        _connection.commit()
+    return result
+
+
+def list_projects(client):
+    return _cached_listing('projects', '', lambda: [x.project_id for x in client.list_projects()])
+
+
+def list_datasets(client, project):
+    # Only the id and location of a dataset are kept, that is all the checks read from a list item
+    def fetch():
+        return [(dataset.dataset_id, dataset._properties.get('location')) for dataset in client.list_datasets(project)]
+
+    datasets = _cached_listing('datasets', project, fetch)
+    return [DatasetListItem({'datasetReference': {'projectId': project, 'datasetId': dataset_id},
+                             'location': location}) for dataset_id, location in datasets]
+
+
+def signature_query(project, datasets):
+    return '\nUNION ALL\n'.join(
+        "SELECT '{dataset}' AS dataset_id, MAX(last_modified_time) AS last_modified_time, COUNT(*) AS table_count "
+        "FROM `{project}.{dataset}.`.__TABLES__".format(project=project, dataset=dataset) for dataset in datasets)
+
+
+def project_signatures(client, project, datasets):
+    # A dataset changes whenever one of its tables does, or a table is added or dropped; the datasets of a project
+    # are checked a batch at a time instead of one call each
+    signatures = {}
+    for start in range(0, len(datasets), DATASETS_PER_QUERY):
+        batch = datasets[start:start + DATASETS_PER_QUERY]
+        try:
+            df = bq_read.query_dataframe(client, signature_query(project, batch))
+        except Exception as exe:
+            # Without a signature the columns of the datasets are read again
+            print('Could not get the tables of {} datasets of {}: {}'.format(len(batch), project, str(exe)[:200]))
+            continue
+        for row in df.itertuples():
+            signatures[(project, row.dataset_id)] = '{}/{}'.format(row.last_modified_time, row.table_count)
+    return signatures
+
+
+def stale_datasets(client, units, max_concurrent_jobs=1, stage=None):
+    # units are (project, dataset); returns the signature of every dataset and the ones whose columns have to be read
+    # again
+    projects = {}
+    for project, dataset in units:
+        projects.setdefault(project, []).append(dataset)
+
+    def signatures_of(project, datasets):
+        # The queries run in the threads of the pool, which don't have the context of the stage
+        with metrics.context(stage, project):
+            return project_signatures(client, project, datasets)
+
+    modified = {}
+    with ThreadPoolExecutor(max_workers=max(max_concurrent_jobs, 1)) as executor:
+        for signatures in executor.map(lambda item: signatures_of(*item), projects.items()):
+            modified.update(signatures)
+    stale = []
+    for unit in units:
+        with _lock:
+            row = _connection.execute('SELECT modified, fetched_at FROM columns WHERE project = ? AND dataset = ?',
+                                      unit).fetchone()
+        signature = modified.get(unit)
+        valid = row is not None and signature is not None and row[0] == signature and _fresh(row[1])
+        _count(valid)
+        if not valid:
+            stale.append(unit)
+    return modified, stale
+
+
+def load_columns(project, dataset):
+    with _lock:
+        row = _connection.execute('SELECT result FROM columns WHERE project = ? AND dataset = ?',
+                                  (project, dataset)).fetchone()
+    return pickle.loads(row[0]) if row is not None else None
+
+
+def save_columns(project, dataset, modified, df):
+    with _lock:
+        _connection.execute('INSERT OR REPLACE INTO columns VALUES (?, ?, ?, ?, ?)',
+                            (project, dataset, modified, time.time(), pickle.dumps(df)))
+        _connection.commit()
+
+
+def report():
+    if _connection is None:
+        return
+    print('Metadata cache: {} hits, {} misses'.format(_hits, _misses))
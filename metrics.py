@@ -0,0 +1,158 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file measures where the time of a run goes: every query, download, parse and upload is recorded as a span with
+its wall time, rows, bytes processed, slot milliseconds and job id, under the stage, project and dataset it ran for.
+Input:
+    1. The stage, project and dataset the current thread works on, set with context()
+    2. The spans, opened with span() around the work they measure
+Output: A JSON report, a Prometheus textfile and a summary of the slowest datasets, written by report()
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+OPERATIONS = ['query', 'download', 'parse', 'upload', 'copy']
+
+_spans = []
+_spans_lock = threading.Lock()
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def context(stage=None, project=None, dataset=None):
+    # Spans opened by the current thread inside this block are recorded under this stage, project and dataset
+    previous = getattr(_context, 'value', {})
+    current = dict(previous)
+    current.update({key: value for key, value in (('stage', stage), ('project', project), ('dataset', dataset))
+                    if value is not None})
+    _context.value = current
+    try:
+        yield
+    finally:
+        _context.value = previous
+
+
+def new_span(operation, rows=None):
+    record = dict(getattr(_context, 'value', {}))
+    record.update({'operation': operation, 'rows': rows, 'bytes_processed': None, 'slot_ms': None, 'job_id': None})
+    return record
+
+
+def add_span(record, wall_time_s):
+    record['wall_time_s'] = wall_time_s
+    with _spans_lock:
+        _spans.append(record)
+
+
+@contextlib.contextmanager
+def span(operation, rows=None):
+    record = new_span(operation, rows)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as exe:
+        record['error'] = '{}: {}'.format(type(exe).__name__, str(exe)[:200])
+        raise
+    finally:
+        add_span(record, time.perf_counter() - start)
+
+
+def record_job(record, job):
+    record['job_id'] = getattr(job, 'job_id', None)
+    record['bytes_processed'] = getattr(job, 'total_bytes_processed', None)
+    record['slot_ms'] = getattr(job, 'slot_millis', None)
+
+
+def summarize(spans):
+    stages = {}
+    for record in spans:
+        totals = stages.setdefault(record.get('stage') or 'other', {}).setdefault(record['operation'], {
+            'count': 0, 'wall_time_s': 0.0, 'rows': 0, 'bytes_processed': 0, 'slot_ms': 0})
+        totals['count'] += 1
+        totals['wall_time_s'] += record['wall_time_s']
+        for key in ('rows', 'bytes_processed', 'slot_ms'):
+            totals[key] += record[key] or 0
+    return stages
+
+
+def slowest_datasets(spans, top_n=10):
+    datasets = {}
+    for record in spans:
+        if record.get('project') is None:
+            continue
+        key = (record.get('stage') or 'other', record['project'], record.get('dataset') or '')
+        datasets[key] = datasets.get(key, 0.0) + record['wall_time_s']
+    return sorted(datasets.items(), key=lambda item: item[1], reverse=True)[:top_n]
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(stages, labels=None):
+    metrics = [('data_defender_operations_total', 'count', 'Operations run'),
+               ('data_defender_operation_seconds_total', 'wall_time_s', 'Wall time spent in operations'),
+               ('data_defender_rows_total', 'rows', 'Rows handled by operations'),
+               ('data_defender_bytes_processed_total', 'bytes_processed', 'Bytes processed by BigQuery jobs'),
+               ('data_defender_slot_milliseconds_total', 'slot_ms', 'Slot milliseconds used by BigQuery jobs')]
+    # The files of several workers are read by the same collector, their extra labels keep the series apart
+    extra = ''.join(',{}="{}"'.format(label, _label(value)) for label, value in sorted((labels or {}).items()))
+    lines = []
+    for name, key, description in metrics:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} counter'.format(name))
+        for stage, operations in sorted(stages.items()):
+            for operation, totals in sorted(operations.items()):
+                lines.append('{}{{stage="{}",operation="{}"{}}} {}'.format(name, _label(stage), _label(operation),
+                                                                          extra, totals[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def report(report_path=None, prometheus_path=None, top_n=10, labels=None):
+    with _spans_lock:
+        spans = list(_spans)
+    stages = summarize(spans)
+    slowest = slowest_datasets(spans, top_n)
+
+    if report_path:
+        slowest_json = [{'stage': stage, 'project': project, 'dataset': dataset, 'wall_time_s': wall_time}
+                        for (stage, project, dataset), wall_time in slowest]
+        with open(report_path, 'w') as f:
+            json.dump({'stages': stages, 'slowest_datasets': slowest_json, 'spans': spans}, f, indent=2, default=str)
+    if prometheus_path:
+        # Written next to the file and renamed, so a collector never reads a half written file
+        with open(prometheus_path + '.tmp', 'w') as f:
+            f.write(prometheus_text(stages, labels))
+        os.replace(prometheus_path + '.tmp', prometheus_path)
+
+    if slowest:
+        print('Slowest datasets:')
+        for (stage, project, dataset), wall_time in slowest:
+            print('    {:.1f}s {} {}'.format(wall_time, stage, '.'.join(filter(None, [project, dataset]))))
+    for stage, operations in stages.items():
+        print('{}: {}'.format(stage, ', '.join('{} {:.1f}s'.format(operation, operations[operation]['wall_time_s'])
+                                               for operation in OPERATIONS if operation in operations)))
@@ -0,0 +1,109 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file keeps the columns parsed out of each query so the same query is only parsed once.
+Queries are keyed by a fingerprint of their text without literals, comments and extra whitespace, so scheduled
+queries that only differ in their dates or ids share one entry.
+Input:
+    1. Maximum number of fingerprints to keep in memory
+    2. Optional path of a local SQLite file that keeps the parsed columns between runs
+Output: The cached columns of a query, plus hit and miss counters
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import re
+import sqlite3
+
+# Identifiers in backticks are kept as is, string and number literals become '?', comments and whitespace become ' '
+NORMALIZE_PATTERN = re.compile(r"""(`[^`]*`)"""
+                               r"""|('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")"""
+                               r"""|((?<![\w.\-])\d+(?:\.\d+)?(?!\w))"""
+                               r"""|(--[^\n]*|#[^\n]*|/\*.*?\*/|\s+)""", re.S)
+
+
+def _normalize_token(match):
+    if match.group(1):
+        return match.group(1)
+    if match.group(2) or match.group(3):
+        return '?'
+    return ' '
+
+
+def fingerprint(query):
+    normalized = NORMALIZE_PATTERN.sub(_normalize_token, query).strip()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class ParseCache:
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS parsed_queries (fingerprint TEXT PRIMARY KEY, columns TEXT)')
+
+    # Returns (found, columns), the columns are None for a query that could not be parsed
+    def get(self, query):
+        key = fingerprint(query)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+
+        if self.connection is not None:
+            row = self.connection.execute('SELECT columns FROM parsed_queries WHERE fingerprint = ?',
+                                          (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                columns = json.loads(row[0])
+                self._remember(key, columns)
+                return True, columns
+
+        self.misses += 1
+        return False, None
+
+    def put(self, query, columns):
+        key = fingerprint(query)
+        columns = list(columns) if columns is not None else None
+        self._remember(key, columns)
+        if self.connection is not None:
+            self.connection.execute('INSERT OR REPLACE INTO parsed_queries VALUES (?, ?)', (key, json.dumps(columns)))
+
+    def _remember(self, key, columns):
+        self.entries[key] = columns
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+        print('Parse cache: {} hits, {} misses'.format(self.hits, self.misses))
@@ -0,0 +1,111 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file parses the columns out of queries, either in the current process or spread over a pool of worker processes
+Input:
+    1. The queries to parse
+    2. The number of worker processes and the number of seconds a single query may take to parse, set once per stage
+Output: The columns of every query as soon as it is parsed, or the reason it could not be parsed
+"""
+
+import multiprocessing
+import signal
+import threading
+from sql_metadata import Parser
+
+CHUNK_SIZE = 64
+
+_parse_timeout = None
+
+
+class ParseTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ParseTimeout('Parsing took more than {} seconds'.format(_parse_timeout))
+
+
+def timed_out(error):
+    return error is not None and error.startswith(ParseTimeout.__name__ + ':')
+
+
+def parse_columns(query, timeout=None):
+    # The timeout relies on SIGALRM, so it is only enforced on platforms that have it and in the main thread
+    use_alarm = bool(timeout) and hasattr(signal, 'setitimer') and \
+        threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        global _parse_timeout
+        _parse_timeout = timeout
+        previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return list(Parser(query).columns), None
+    except Exception as exe:
+        return None, '{}: {}'.format(type(exe).__name__, str(exe)[:200])
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+
+def _init_worker(timeout):
+    global _parse_timeout
+    _parse_timeout = timeout
+
+
+def _parse_indexed(indexed_query):
+    index, query = indexed_query
+    columns, error = parse_columns(query, _parse_timeout)
+    return index, columns, error
+
+
+class ParsePool:
+    # The worker processes are started once per stage, before any result is downloaded, and from a fresh interpreter:
+    # forking a process that already runs the threads of the BQ clients could leave their locks held in the workers
+    def __init__(self, parse_workers=1, timeout=None):
+        self.timeout = timeout
+        self.pool = None
+        if parse_workers > 1:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.pool = multiprocessing.get_context(start_method).Pool(parse_workers, initializer=_init_worker,
+                                                                       initargs=(timeout,))
+
+    def iter_parsed(self, queries):
+        if self.pool is None:
+            for query in queries:
+                columns, error = parse_columns(query, self.timeout)
+                yield query, columns, error
+            return
+
+        # Only the index of a query comes back from the workers, the text itself is only sent once
+        queries = list(queries)
+        for index, columns, error in self.pool.imap_unordered(_parse_indexed, enumerate(queries),
+                                                              chunksize=CHUNK_SIZE):
+            yield queries[index], columns, error
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,133 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file runs the queries of a check, either one after the other or with several BQ jobs running at once.
+A check can run one query per dataset, or one query per project and region that covers all the datasets of that region
+and falls back to one query per dataset for the datasets the regional query could not load.
+Input:
+    1. A BQ client
+    2. The units to run (project, dataset) and a function that formats the query of a single unit, the job of a unit
+       runs in the project of the client or in the project of the unit
+    3. The maximum number of BQ jobs allowed to run at the same time
+Output: The result of every unit that loaded, in the same order as the units were given
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bq_read
+import budget
+import checkpoint
+import metadata_cache
+import metrics
+
+
+def run_unit(client, unit, build_query, stage=None, categories=None, run_in_project=False):
+    # Units a previous run already loaded are replayed from the checkpoint instead of being queried again
+    df = checkpoint.load(stage, *unit)
+    if df is None:
+        with metrics.context(stage, *unit):
+            df = bq_read.query_dataframe(client, build_query(unit), categories, unit[0] if run_in_project else None)
+        checkpoint.save(stage, *unit, df)
+    return df
+
+
+def plan_units(client, units, build_query, max_concurrent_jobs=1, stage=None):
+    # Units a previous run already loaded don't run a query, so they are always kept and left out of the plan
+    loaded = {unit for unit in units if checkpoint.has(stage, *unit)}
+    planned = set(budget.plan(client, [unit for unit in units if unit not in loaded], build_query,
+                              max_concurrent_jobs, stage))
+    return [unit for unit in units if unit in loaded or unit in planned]
+
+
+def iter_results(client, units, build_query, max_concurrent_jobs=1, stage=None, categories=None,
+                 run_in_project=False):
+    if budget.enabled():
+        units = plan_units(client, list(units), build_query, max_concurrent_jobs, stage)
+    if max_concurrent_jobs <= 1:
+        for unit in units:
+            try:
+                yield unit, run_unit(client, unit, build_query, stage, categories, run_in_project)
+            except Exception as exe:
+                report_failure(unit, exe)
+        return
+
+    # Jobs keep running in the background while we wait for the oldest one, so the results come back
+    # in the order of the units no matter which job finishes first
+    window = max_concurrent_jobs * 2
+    units = iter(units)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_concurrent_jobs) as executor:
+        while True:
+            while len(pending) < window:
+                unit = next(units, None)
+                if unit is None:
+                    break
+                pending.append((unit, executor.submit(run_unit, client, unit, build_query, stage, categories,
+                                                      run_in_project)))
+            if not pending:
+                break
+
+            unit, future = pending.popleft()
+            try:
+                yield unit, future.result()
+            except Exception as exe:
+                report_failure(unit, exe)
+
+
+def report_failure(unit, exe):
+    if isinstance(exe, budget.BudgetExceeded):
+        print('Deferring {}: {}'.format('.'.join(filter(None, unit)), exe))
+    else:
+        print('Could not load since: ', str(exe)[:200])
+
+
+def list_datasets(client, projects, max_concurrent_jobs=1):
+    # The datasets of several projects are listed at once, they come back in the order of the projects
+    with ThreadPoolExecutor(max_workers=max(max_concurrent_jobs, 1)) as executor:
+        datasets = executor.map(lambda project: metadata_cache.list_datasets(client, project), projects)
+        return list(zip(projects, datasets))
+
+
+def dataset_region(dataset):
+    # datasets.list returns the location of every dataset, DatasetListItem just doesn't expose it as a property
+    location = dataset._properties.get('location')
+    if not location:
+        return None
+    return 'region-{}'.format(location.lower())
+
+
+def iter_region_results(client, dataset_units, build_region_query, build_dataset_query, max_concurrent_jobs=1,
+                        stage=None, categories=None):
+    # dataset_units are (project, dataset, region), regions keep the order their first dataset was listed in
+    region_units = list(dict.fromkeys((project, region) for project, dataset, region in dataset_units
+                                      if region is not None))
+    loaded = set()
+    for unit, df in iter_results(client, region_units, build_region_query, max_concurrent_jobs, stage, categories):
+        loaded.add(unit)
+        yield unit, df
+
+    fallback_units = [(project, dataset) for project, dataset, region in dataset_units
+                      if (project, region) not in loaded]
+    if fallback_units:
+        print('Loading {} datasets one by one'.format(len(fallback_units)))
+    yield from iter_results(client, fallback_units, build_dataset_query, max_concurrent_jobs, stage, categories)
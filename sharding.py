@@ -0,0 +1,153 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file splits the work of a stage between several workers, each one running as its own process.
+Every worker lists the same units (projects or datasets) with the same weights and assigns them the same way, heaviest
+first to the lightest shard, so the workers agree on who runs what without talking to each other. A worker writes its
+output to its own <table>_shard_<index> tables, and once every worker of a stage finished, the merge step unions the
+shard tables into the same Data_Defender tables a single process would have written.
+Input:
+    1. The index of the worker and the number of workers, set once with configure()
+    2. The units of a stage and their weights
+Output: The units of the current worker, and the names of the tables it writes to
+"""
+
+import heapq
+import os
+from google.api_core.exceptions import NotFound
+import bq_read
+
+_shard_index = None
+_shard_count = 1
+
+
+def configure(shard_index=None, shard_count=1):
+    global _shard_index, _shard_count
+    _shard_index = shard_index
+    _shard_count = shard_count
+
+
+def enabled():
+    return _shard_index is not None
+
+
+def shard_path(path, shard_index=None):
+    # Every worker keeps its local files (checkpoint, metrics) next to the ones of a single process run
+    if path is None:
+        return None
+    root, extension = os.path.splitext(path)
+    return '{}.shard-{}{}'.format(root, _shard_index if shard_index is None else shard_index, extension)
+
+
+def stage_path(path, stages):
+    # The workers and merges of every phase keep their own files, a later phase doesn't overwrite an earlier one
+    if path is None:
+        return None
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, '-'.join(stages), extension)
+
+
+def table(destination_table, shard_index=None):
+    if shard_index is None:
+        if not enabled():
+            return destination_table
+        shard_index = _shard_index
+    return '{}_shard_{}'.format(destination_table, shard_index)
+
+
+def assign(units, weights, shard_count):
+    # Heaviest units first, each to the shard with the least weight so far; ties go by unit and then by shard, so the
+    # assignment only depends on the units and their weights
+    shards = [[] for _ in range(shard_count)]
+    loads = [(0, shard) for shard in range(shard_count)]
+    for weight, unit in sorted(zip(weights, units), key=lambda item: (-item[0], str(item[1]))):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(unit)
+        heapq.heappush(loads, (load + weight, shard))
+    return shards
+
+
+def select(units, weights, name='units'):
+    if not enabled():
+        return units
+    selected = set(assign(units, weights, _shard_count)[_shard_index])
+    selected_weight = sum(weight for unit, weight in zip(units, weights) if unit in selected)
+    print('Shard {} of {}: {} of {} {} (weight {} of {})'.format(_shard_index, _shard_count, len(selected),
+                                                              len(units), name, selected_weight, sum(weights)))
+    # The units keep the order they were listed in
+    return [unit for unit in units if unit in selected]
+
+
+def select_datasets(dataset_units, by_region=True):
+    # dataset_units are (project, dataset, region); the datasets a single regional query covers go to the same shard,
+    # weighted by how many datasets it covers
+    if not enabled():
+        return dataset_units
+
+    def group(unit):
+        project, dataset, region = unit
+        return (project, region) if by_region and region is not None else (project, dataset)
+
+    sizes = {}
+    for unit in dataset_units:
+        sizes[group(unit)] = sizes.get(group(unit), 0) + 1
+    selected = set(select(list(sizes), list(sizes.values()), 'project regions and datasets'))
+    return [unit for unit in dataset_units if group(unit) in selected]
+
+
+def shard_tables(client, project_name, shard_table, shard_count):
+    # Shards without rows are left out, they may not have the columns of the others; a missing shard table means its
+    # worker did not finish and fails the merge, so it is never merged as if it had no rows
+    tables = []
+    for shard in range(shard_count):
+        name = '{}.{}'.format(project_name, table(shard_table, shard))
+        try:
+            num_rows = client.get_table(name).num_rows
+        except NotFound:
+            print('Could not find {}, shard {} of {} did not finish'.format(name, shard, shard_count))
+            raise
+        if num_rows:
+            tables.append(name)
+    return tables or ['{}.{}'.format(project_name, table(shard_table, 0))]
+
+
+def union_query(tables):
+    return '\n            UNION ALL\n'.join('            SELECT * FROM `{}`'.format(name) for name in tables)
+
+
+def replace_table(client, project_name, destination_table, select_query):
+    create_query = 'CREATE OR REPLACE TABLE `{}.{}` AS\n{}'.format(project_name, destination_table, select_query)
+    bq_read.run_query(client, create_query)
+
+
+def drop_shards(client, project_name, shard_table, shard_count):
+    for shard in range(shard_count):
+        client.delete_table('{}.{}'.format(project_name, table(shard_table, shard)), not_found_ok=True)
+
+
+def merge_union(client, project_name, destination_table, shard_count, shard_table=None, select_query='{}'):
+    # select_query wraps the union of the shards, when their rows have to be combined
+    shard_table = shard_table or destination_table
+    union = union_query(shard_tables(client, project_name, shard_table, shard_count))
+    replace_table(client, project_name, destination_table, select_query.format(union))
+    drop_shards(client, project_name, shard_table, shard_count)
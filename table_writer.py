@@ -0,0 +1,177 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This file uploads the output of a check to a BQ table in bounded chunks.
+Rows are buffered until a chunk is full (by rows or by memory) and each chunk is loaded as Parquet into a loading table.
+When the check is done the loading table replaces the destination table in a single copy job, so a run that fails
+halfway never leaves a half written table behind and the previous table stays in place.
+Input:
+    1. A BQ client, the project and the destination table
+    2. DataFrames of output rows, in any number and size
+Output: The destination table replaced by all the rows written
+"""
+
+from google.cloud import bigquery
+import numpy as np
+import pandas as pd
+import pandas_gbq.schema
+import sys
+import bq_read
+import metrics
+
+_chunk_rows = 500000
+_max_memory_mb = 1024
+
+
+def configure(chunk_rows=500000, max_memory_mb=1024):
+    global _chunk_rows, _max_memory_mb
+    _chunk_rows = chunk_rows
+    _max_memory_mb = max_memory_mb
+
+
+def category_bytes(df):
+    # The bytes every category of the categorical columns takes once it is turned back into its value, and the pointer
+    # to it; a row missing its category points at None
+    sizes = {}
+    for column, dtype in df.dtypes.items():
+        if not isinstance(dtype, pd.CategoricalDtype):
+            continue
+        categories = dtype.categories
+        if categories.dtype == object:
+            category_sizes = np.fromiter((sys.getsizeof(value) for value in categories), dtype=np.int64,
+                                         count=len(categories)) + 8
+        else:
+            category_sizes = np.full(len(categories), categories.dtype.itemsize, dtype=np.int64)
+        sizes[column] = np.append(category_sizes, 8)
+    return sizes
+
+
+def chunk_bytes(chunk, sizes):
+    # The memory usage of a categorical slice counts all the categories of the column, which every slice shares;
+    # a chunk is measured by the size of the values its rows point at
+    size = 0
+    for column in chunk.columns:
+        if column in sizes:
+            size += int(sizes[column][chunk[column].cat.codes.values].sum())
+        else:
+            size += int(chunk[column].memory_usage(deep=True, index=False))
+    return size
+
+
+def decategorize(df):
+    # Categories only save memory while the rows are held, the table gets the plain values
+    columns = [column for column, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    if not columns:
+        return df
+    return df.astype({column: df[column].cat.categories.dtype for column in columns})
+
+
+def concat_chunks(frames):
+    # The categories of the chunks are merged instead of being turned back into values
+    categories = [column for column in frames[0].columns
+                  if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames)]
+    return bq_read.concat_frames(frames, categories)
+
+
+class TableWriter:
+    def __init__(self, client, project_name, destination_table):
+        self.client = client
+        self.destination = bigquery.TableReference.from_string('{}.{}'.format(project_name, destination_table))
+        self.loading = bigquery.TableReference.from_string('{}.{}_loading'.format(project_name, destination_table))
+        self.buffer = []
+        self.buffer_rows = 0
+        self.buffer_bytes = 0
+        self.empty_frame = None
+        self.schema = None
+        self.rows_written = 0
+
+    def write(self, df):
+        if self.empty_frame is None:
+            self.empty_frame = df.iloc[:0]
+        sizes = category_bytes(df)
+        for start in range(0, len(df), _chunk_rows):
+            chunk = df.iloc[start:start + _chunk_rows]
+            self.buffer.append(chunk)
+            self.buffer_rows += len(chunk)
+            self.buffer_bytes += chunk_bytes(chunk, sizes)
+            if self.buffer_rows >= _chunk_rows or self.buffer_bytes >= _max_memory_mb * 1024 * 1024:
+                self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = concat_chunks(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+        self._load(chunk)
+        self.buffer = []
+        self.buffer_rows = 0
+        self.buffer_bytes = 0
+
+    def _load(self, chunk):
+        # The schema of the first chunk is the one to_gbq would have given the table, the next chunks follow it. The
+        # categories are loaded as they are, the client turns them straight into Arrow strings
+        first_chunk = self.schema is None
+        if first_chunk:
+            self.schema = [bigquery.SchemaField.from_api_repr(field)
+                           for field in pandas_gbq.schema.generate_bq_schema(decategorize(chunk.iloc[:0]))['fields']]
+        job_config = bigquery.LoadJobConfig(schema=self.schema,
+                                            write_disposition='WRITE_TRUNCATE' if first_chunk else 'WRITE_APPEND',
+                                            source_format=bigquery.SourceFormat.PARQUET)
+        with metrics.span('upload', len(chunk)) as record:
+            job = self.client.load_table_from_dataframe(chunk, self.loading, job_config=job_config)
+            job.result()
+            metrics.record_job(record, job)
+        self.rows_written += len(chunk)
+
+    def close(self):
+        self.flush()
+        if self.schema is None:
+            # Without even an empty frame to take the columns from the destination could only be left as it was, with
+            # the rows of an older run
+            if self.empty_frame is None:
+                raise ValueError('Nothing was written to {}, write an empty frame to replace it with no rows'.format(
+                    self.destination))
+            self._load(self.empty_frame)
+
+        job_config = bigquery.CopyJobConfig(write_disposition='WRITE_TRUNCATE')
+        with metrics.span('copy', self.rows_written) as record:
+            job = self.client.copy_table(self.loading, self.destination, job_config=job_config)
+            job.result()
+            metrics.record_job(record, job)
+        self.client.delete_table(self.loading, not_found_ok=True)
+
+
+def copy_table(client, project_name, source_table, destination_table, append=False):
+    # Copy jobs are not billed, the rows never leave BQ
+    job_config = bigquery.CopyJobConfig(write_disposition='WRITE_APPEND' if append else 'WRITE_TRUNCATE')
+    with metrics.span('copy') as record:
+        job = client.copy_table(bigquery.TableReference.from_string('{}.{}'.format(project_name, source_table)),
+                                bigquery.TableReference.from_string('{}.{}'.format(project_name, destination_table)),
+                                job_config=job_config)
+        job.result()
+        metrics.record_job(record, job)
+
+
+def write_table(client, project_name, destination_table, df):
+    writer = TableWriter(client, project_name, destination_table)
+    writer.write(df)
+    writer.close()
@@ -0,0 +1,109 @@
+# MIT License
+
+# Copyright (c) 2023 HUMAN Security.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bq_read  # noqa: E402
+import budget  # noqa: E402
+
+
+MB = 1024 * 1024
+
+
+class StubJob:
+    def __init__(self, total_bytes_processed=0, total_bytes_billed=None):
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_billed
+
+    def result(self):
+        return []
+
+
+class StubClient:
+    # Dry runs estimate the size set for the query, real runs record the job config they were given and bill the
+    # size set for them, or their estimate
+    def __init__(self, sizes, billed=None):
+        self.sizes = sizes
+        self.billed = billed or {}
+        self.job_configs = []
+
+    def query(self, query, job_config=None, **kwargs):
+        if job_config is not None and job_config.dry_run:
+            return StubJob(self.sizes[query])
+        self.job_configs.append(job_config)
+        return StubJob(total_bytes_billed=self.billed.get(query, self.sizes.get(query)))
+
+
+@pytest.fixture(autouse=True)
+def no_budget():
+    yield
+    budget.configure(None)
+
+
+def test_cap_is_not_below_estimate():
+    budget.configure(100 * MB)
+    client = StubClient({'first': 60 * MB, 'second': 30 * MB})
+    bq_read.run_query(client, 'first')
+    bq_read.run_query(client, 'second')
+    assert client.job_configs[0].maximum_bytes_billed >= 60 * MB
+    assert client.job_configs[1].maximum_bytes_billed >= 30 * MB
+    # The cap never lets a job bill more than what was left of the budget when it started
+    assert client.job_configs[0].maximum_bytes_billed <= 100 * MB
+    assert client.job_configs[1].maximum_bytes_billed <= 40 * MB
+
+
+def test_query_over_budget_is_not_run():
+    budget.configure(100 * MB)
+    client = StubClient({'first': 60 * MB, 'second': 50 * MB})
+    bq_read.run_query(client, 'first')
+    with pytest.raises(budget.BudgetExceeded):
+        bq_read.run_query(client, 'second')
+    assert len(client.job_configs) == 1
+    assert budget.deferred() == 1
+
+
+def test_no_cap_without_budget():
+    client = StubClient({})
+    bq_read.run_query(client, 'first')
+    assert client.job_configs == [None]
+
+
+def test_budget_is_charged_the_bytes_billed():
+    budget.configure(100 * MB)
+    client = StubClient({'first': 60 * MB, 'second': 50 * MB}, billed={'first': 20 * MB})
+    bq_read.run_query(client, 'first')
+    assert budget.remaining() == 80 * MB
+    # The second query only fits because the first one billed less than its estimate
+    bq_read.run_query(client, 'second')
+    assert budget.remaining() == 30 * MB
+
+
+def test_small_queries_are_estimated_at_the_minimum_bill():
+    budget.configure(15 * MB)
+    client = StubClient({'first': 1, 'second': 1}, billed={'first': budget.MIN_BYTES_BILLED})
+    bq_read.run_query(client, 'first')
+    with pytest.raises(budget.BudgetExceeded):
+        bq_read.run_query(client, 'second')
@@ -24,14 +24,82 @@
 This file extracts the logs from each project you have permissions to under your BQ account and pushes it into a BQ table
 Input: Relevant credentials for BQ access
 Output: BQ table with last time a table was called
+After the first run only the jobs that started after the previous run are scanned and merged into the table,
+unless a full refresh is asked for
 """
 
 
 import pandas as pd
-from google.cloud import bigquery
+import bq_read
+import budget
+import metadata_cache
+import query_dispatch
+import sharding
+import table_writer
 import os
 
-def extracting_logs(client, project_name):
+# INFORMATION_SCHEMA.JOBS only keeps 180 days of jobs, tables that were not called since are dropped from total_logs
+RETENTION_DAYS = 180
+
+# Columns repeated over many logs, held as categories until they are uploaded
+LOG_CATEGORIES = ['user_email', 'job_type', 'project_id', 'dataset_id', 'table_id', 'query']
+
+# The logs total_logs got since used_columns last parsed them, whatever day they were called on
+CHANGES_TABLE = 'Data_Defender.total_logs_changes'
+
+TOTAL_LOGS_COLUMNS = ['user_email', 'job_type', 'last_run_date', 'project_id', 'dataset_id', 'table_id', 'query',
+                      'last_call']
+
+
+def read_watermarks(client, project_name):
+    watermarks_query = """
+            SELECT project_id, last_start_time
+            FROM `{}.Data_Defender.total_logs_watermarks`
+    """
+    try:
+        df = bq_read.query_dataframe(client, watermarks_query.format(project_name))
+    except budget.BudgetExceeded:
+        # Not knowing the watermarks is no reason to scan all the jobs again
+        raise
+    except Exception as exe:
+        print('Could not load total logs watermarks, running a full refresh')
+        return {}
+    return dict(zip(df.project_id, df.last_start_time))
+
+
+def merge_logs(client, project_name):
+    merge_query = """
+            MERGE `{project_name}.Data_Defender.total_logs` AS logs
+            USING (
+                SELECT * EXCEPT(newest_call)
+                FROM (
+                    SELECT  *,
+                            row_number() OVER (PARTITION BY project_id,dataset_id,table_id order by last_run_date desc) as newest_call
+                    FROM `{project_name}.Data_Defender.total_logs_staging`
+                    )
+                WHERE newest_call = 1
+                ) AS new_logs
+            ON logs.project_id = new_logs.project_id
+                AND logs.dataset_id = new_logs.dataset_id
+                AND logs.table_id = new_logs.table_id
+            WHEN MATCHED AND new_logs.last_run_date >= logs.last_run_date THEN
+                UPDATE SET  user_email = new_logs.user_email,
+                            job_type = new_logs.job_type,
+                            last_run_date = new_logs.last_run_date,
+                            query = new_logs.query,
+                            last_call = new_logs.last_call
+            WHEN NOT MATCHED THEN
+                INSERT ROW;
+
+            DELETE FROM `{project_name}.Data_Defender.total_logs`
+            WHERE last_run_date < TIMESTAMP(DATE_SUB(CURRENT_DATE(), INTERVAL {retention_days} day));
+    """
+    bq_read.run_query(client, merge_query.format(project_name=project_name, retention_days=RETENTION_DAYS))
+    table_writer.copy_table(client, project_name, 'Data_Defender.total_logs_staging', CHANGES_TABLE, append=True)
+    client.delete_table('{}.Data_Defender.total_logs_staging'.format(project_name), not_found_ok=True)
+
+
+def extracting_logs(client, project_name, full_refresh=False, max_concurrent_jobs=1):
     total_logs_query = """
             SELECT * 
             FROM (
@@ -42,40 +110,115 @@ def extracting_logs(client, project_name):
                         dataset_id,
                         table_id,
                         query,
-                        row_number() OVER (PARTITION BY project_id,dataset_id,table_id order by last_run_date desc) as last_call
+                        row_number() OVER (PARTITION BY project_id,dataset_id,table_id order by last_run_date desc) as last_call,
+                        LEAST(max(start_time) OVER (),
+                              IFNULL(TIMESTAMP_SUB(first_running_start_time, INTERVAL 1 MICROSECOND),
+                                     TIMESTAMP('9999-12-31'))) as next_watermark
                 FROM  (
                     SELECT  user_email,
                             job_type, 
                             date(start_time) as last_run_date,
+                            start_time,
+                            state,
                             referenced_tables,
                             query,
-                    FROM `{}.`.`region-us`.INFORMATION_SCHEMA.JOBS
-                    WHERE query IS NOT NULL
+                            min(IF(state != 'DONE', start_time, NULL)) OVER () as first_running_start_time
+                    FROM `{project}.`.`region-us`.INFORMATION_SCHEMA.JOBS
+                    WHERE query IS NOT NULL {new_jobs_filter}
                         ),unnest(referenced_tables)
+                WHERE state = 'DONE'
                     )
           where last_call = 1
     """
+    # Jobs only get their referenced tables once they are done, so the next run starts before the first job that was
+    # still running and scans it again; the jobs done since then are scanned twice and the merge keeps one log of them
+    # creation_time is the partitioning column of JOBS, filtering on it as well keeps the scan to the new partitions
+    new_jobs_filter = """
+                        AND creation_time > TIMESTAMP_SUB(TIMESTAMP('{watermark}'), INTERVAL 1 day)
+                        AND start_time > TIMESTAMP('{watermark}')
+    """
+
+    watermarks = {} if full_refresh else read_watermarks(client, project_name)
+    incremental = len(watermarks) > 0
+
+    # In incremental mode the new logs are loaded next to total_logs and then merged into it, a shard leaves its logs
+    # in its own table and the merge step takes care of that
+    destination_table = 'Data_Defender.total_logs_staging' if incremental else 'Data_Defender.total_logs'
+    if sharding.enabled():
+        destination_table = sharding.table('Data_Defender.total_logs')
+    logs_writer = table_writer.TableWriter(client, project_name, destination_table)
+
+    def build_query(unit):
+        project = unit[0]
+        jobs_filter = ''
+        if project in watermarks:
+            jobs_filter = new_jobs_filter.format(watermark=watermarks[project].isoformat())
+        return total_logs_query.format(project=project, new_jobs_filter=jobs_filter)
+
+    projects = metadata_cache.list_projects(client)
+    if sharding.enabled():
+        # Projects are weighted by their number of datasets, which every worker lists the same
+        projects = sharding.select(projects, [max(len(datasets), 1) for project, datasets in
+                                              query_dispatch.list_datasets(client, projects, max_concurrent_jobs)],
+                                   'projects')
+    # Every project's jobs run in that project, all through the same client; projects a previous run already loaded
+    # are replayed from the checkpoint
+    deferred = budget.deferred()
+    results = query_dispatch.iter_results(client, [(project, '') for project in projects], build_query,
+                                          max_concurrent_jobs, 'total_logs', LOG_CATEGORIES, run_in_project=True)
+    for (project, _), df in results:
+        if (len(df) > 0):
+            watermarks[project] = df.next_watermark.max()
+            df = df.drop(columns='next_watermark')
+            df.last_run_date = df.last_run_date.astype(
+                'datetime64[ns]')  # Changing the type of the date so BQ will be able to load it
+            logs_writer.write(df)
 
-    projects = [x.project_id for x in client.list_projects()]
-    all_logs_df = pd.DataFrame()
-    for project in projects:
-        # credentials
-        client = bigquery.Client(project=project)
-        try:
-            df = client.query(total_logs_query.format(project)).result().to_dataframe()
-            if (len(df) > 0):
-                all_logs_df = pd.concat([all_logs_df, df], ignore_index=True, sort=False)
-
-        except Exception as exe:
-            print('Could not load project: ', project)
-            pass
-
-    all_logs_df.last_run_date = all_logs_df.last_run_date.astype(
-        'datetime64[ns]')  # Changing the type of the date so BQ will be able to load it
-    all_logs_df.to_gbq(destination_table='Data_Defender.total_logs', project_id=project_name, if_exists='replace')
+    if not incremental and budget.deferred() > deferred:
+        # A full refresh replaces every log, so total_logs is only replaced once every project is loaded; --resume
+        # loads the deferred projects and replays the others from the checkpoint
+        print('Keeping the previous total logs until the deferred projects are loaded')
+        return
+
+    if (sharding.enabled() or not incremental) and logs_writer.empty_frame is None:
+        # total_logs is replaced even without logs, and the shard table is what the merge step expects from every
+        # worker; only the staging table is not needed without new logs
+        logs_writer.write(pd.DataFrame(columns=TOTAL_LOGS_COLUMNS).astype({'last_run_date': 'datetime64[ns]',
+                                                                           'last_call': 'int64'}))
+    # Without new logs there is no staging table to load
+    if logs_writer.empty_frame is not None:
+        logs_writer.close()
+    if incremental and logs_writer.rows_written > 0 and not sharding.enabled():
+        merge_logs(client, project_name)
+    elif not incremental and not sharding.enabled():
+        # Every log was replaced, so every log is parsed again
+        table_writer.copy_table(client, project_name, 'Data_Defender.total_logs', CHANGES_TABLE)
+
+    # The watermarks only move forward once the new logs are stored
+    watermarks_df = pd.DataFrame({'project_id': list(watermarks.keys()),
+                                  'last_start_time': pd.to_datetime(list(watermarks.values()), utc=True)})
+    table_writer.write_table(client, project_name, sharding.table('Data_Defender.total_logs_watermarks'),
+                             watermarks_df)
     print('Finished total logs')
 
 
-def main(client, project_name):
-    extracting_logs(client, project_name)
-    
+def merge_shards(client, project_name, shard_count, full_refresh=False):
+    # The workers ran incrementally if the watermarks were there, and they are only replaced below
+    incremental = not full_refresh and len(read_watermarks(client, project_name)) > 0
+    if incremental:
+        sharding.merge_union(client, project_name, 'Data_Defender.total_logs_staging', shard_count,
+                             'Data_Defender.total_logs')
+        merge_logs(client, project_name)
+    else:
+        sharding.merge_union(client, project_name, 'Data_Defender.total_logs', shard_count)
+        table_writer.copy_table(client, project_name, 'Data_Defender.total_logs', CHANGES_TABLE)
+
+    # Every worker kept the watermarks of all the projects and moved the ones of its own projects forward
+    watermarks_query = 'SELECT project_id, MAX(last_start_time) AS last_start_time FROM (\n{}\n) GROUP BY project_id'
+    sharding.merge_union(client, project_name, 'Data_Defender.total_logs_watermarks', shard_count,
+                         select_query=watermarks_query)
+    print('Merged total logs of {} shards'.format(shard_count))
+
+
+def main(client, project_name, full_refresh=False, max_concurrent_jobs=1):
+    extracting_logs(client, project_name, full_refresh, max_concurrent_jobs)
@@ -33,9 +33,21 @@ Output: BQ table of the last time a column was called and how much money your or
 """
 
 import pandas as pd
+import bq_read
+import metadata_cache
+import query_dispatch
+import sharding
+import table_writer
 
+# Every table name is repeated for each of its columns, they are held as categories until they are uploaded
+OUTPUT_CATEGORIES = ['table_name', 'column_name', 'severity_group']
 
-def unused_column(client, project_name):
+OUTPUT_COLUMNS = ['table_name', 'column_name', 'last_run_date', 'severity_group']
+
+SCHEMA_COLUMNS = ['table_catalog', 'table_schema', 'table_name', 'column_name']
+
+
+def unused_column(client, project_name, max_concurrent_jobs=1, metadata_scope='region'):
     unused_columns_query = """ 
 
         WITH used_columns as(
@@ -57,7 +69,7 @@ def unused_column(client, project_name):
             table_schema AS dataset_id,
             REGEXP_REPLACE(table_name, r'\_\d{numbers}', "") AS table_id,
             column_name
-        FROM `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMNS
+        FROM {columns}
     ),
 
     unused_columns_wd as (
@@ -101,29 +113,111 @@ def unused_column(client, project_name):
     FROM unused_columns
     group by 1,2,3,4"""
 
-    projects = [x.project_id for x in client.list_projects()]
-    total_unused_columns = pd.DataFrame()
-    for project in projects:
-        datasets = list(client.list_datasets(project))
+    projects = metadata_cache.list_projects(client)
+    units = []
+    for project, datasets in query_dispatch.list_datasets(client, projects, max_concurrent_jobs):
         if datasets:
             for dataset in datasets:
-                try:
-                    df = client.query(
-                        unused_columns_query.format(project_name=project_name, project=project,
-                                                    dataset=dataset.dataset_id, numbers='{8}')).result().to_dataframe()
-                    if (len(df) > 0):
-                        total_unused_columns = pd.concat([total_unused_columns, df], ignore_index=True, sort=False)
-
-                except Exception as exe:
-                    print('Could not load since: ', str(exe)[:200])
-                    pass
-
-    total_unused_columns.last_run_date = total_unused_columns.last_run_date.astype('datetime64[ns]')
-    total_unused_columns.to_gbq(destination_table='Data_Defender.unused_columns', project_id=project_name,
-                                if_exists='replace')
+                units.append((project, dataset.dataset_id, query_dispatch.dataset_region(dataset)))
+    units = sharding.select_datasets(units, metadata_scope == 'region')
+
+    def build_region_query(unit):
+        project, region = unit
+        columns = '`{}`.`{}`.INFORMATION_SCHEMA.COLUMNS'.format(project, region)
+        return unused_columns_query.format(project_name=project_name, columns=columns, numbers='{8}')
+
+    def build_dataset_query(unit):
+        project, dataset = unit
+        columns = '`{}.{}`.INFORMATION_SCHEMA.COLUMNS'.format(project, dataset)
+        return unused_columns_query.format(project_name=project_name, columns=columns, numbers='{8}')
+
+    if metadata_cache.enabled():
+        results = cached_columns_results(client, project_name, units, unused_columns_query, max_concurrent_jobs,
+                                         metadata_scope)
+    elif metadata_scope == 'region':
+        results = query_dispatch.iter_region_results(client, units, build_region_query, build_dataset_query,
+                                                     max_concurrent_jobs, 'unused_columns', OUTPUT_CATEGORIES)
+    else:
+        results = query_dispatch.iter_results(client, [(project, dataset) for project, dataset, region in units],
+                                              build_dataset_query, max_concurrent_jobs, 'unused_columns',
+                                              OUTPUT_CATEGORIES)
+    columns_writer = table_writer.TableWriter(client, project_name, sharding.table('Data_Defender.unused_columns'))
+    # The table is replaced even without unused columns, and a shard's table is what the merge step expects from
+    # every worker
+    columns_writer.write(pd.DataFrame(columns=OUTPUT_COLUMNS).astype({'last_run_date': 'datetime64[ns]'}))
+    for unit, df in results:
+        if (len(df) > 0):
+            df.last_run_date = df.last_run_date.astype('datetime64[ns]')
+            columns_writer.write(df)
+    columns_writer.close()
     print('Finished unused columns')
 
 
-def main(client, project_name):
-    unused_column(client, project_name)
+def refresh_columns(client, units, max_concurrent_jobs=1, metadata_scope='region'):
+    columns_query = """
+        SELECT table_catalog, table_schema, table_name, column_name
+        FROM {columns}
+    """
+    modified, stale = metadata_cache.stale_datasets(client, [(project, dataset) for project, dataset, region in units],
+                                                    max_concurrent_jobs, 'unused_columns')
+    if not stale:
+        return
+    print('Reading the columns of {} of {} datasets'.format(len(stale), len(units)))
+    stale = set(stale)
+    stale_units = [unit for unit in units if unit[:2] in stale]
+    # The stale datasets a regional or a dataset result has the columns of
+    unit_datasets = {}
+    for project, dataset, region in stale_units:
+        unit_datasets.setdefault((project, region), []).append(dataset)
+        unit_datasets.setdefault((project, dataset), []).append(dataset)
+
+    def build_region_query(unit):
+        return columns_query.format(columns='`{}`.`{}`.INFORMATION_SCHEMA.COLUMNS'.format(*unit))
+
+    def build_dataset_query(unit):
+        return columns_query.format(columns='`{}.{}`.INFORMATION_SCHEMA.COLUMNS'.format(*unit))
+
+    if metadata_scope == 'region':
+        results = query_dispatch.iter_region_results(client, stale_units, build_region_query, build_dataset_query,
+                                                     max_concurrent_jobs, 'column_schemas')
+    else:
+        results = query_dispatch.iter_results(client, [unit[:2] for unit in stale_units], build_dataset_query,
+                                              max_concurrent_jobs, 'column_schemas')
+    for unit, df in results:
+        # A regional query has the columns of every dataset of the region, each stale one is stored on its own; a
+        # dataset without columns is stored empty
+        dataset_dfs = dict(tuple(df.groupby('table_schema', sort=False)))
+        project = unit[0]
+        for dataset in dict.fromkeys(unit_datasets.get(unit, [])):
+            dataset_df = dataset_dfs.get(dataset, df.iloc[:0]).reset_index(drop=True)
+            metadata_cache.save_columns(project, dataset, modified.get((project, dataset)), dataset_df)
+
+
+def cached_columns_results(client, project_name, units, unused_columns_query, max_concurrent_jobs=1,
+                           metadata_scope='region'):
+    # Only the datasets that changed are read again, the columns of all the datasets are then uploaded from the cache
+    # and checked with a single query instead of one per region or dataset
+    refresh_columns(client, units, max_concurrent_jobs, metadata_scope)
+    columns_table = sharding.table('Data_Defender.column_schemas')
+    columns_writer = table_writer.TableWriter(client, project_name, columns_table)
+    columns_writer.write(pd.DataFrame(columns=SCHEMA_COLUMNS))
+    for project, dataset, region in units:
+        df = metadata_cache.load_columns(project, dataset)
+        if df is not None:
+            columns_writer.write(df[SCHEMA_COLUMNS])
+    columns_writer.close()
+
+    columns = '`{}.{}`'.format(project_name, columns_table)
+    query = unused_columns_query.format(project_name=project_name, columns=columns, numbers='{8}')
+    for df in bq_read.iter_query_frames(client, query, None, OUTPUT_CATEGORIES):
+        yield None, df
+
+
+def merge_shards(client, project_name, shard_count):
+    sharding.merge_union(client, project_name, 'Data_Defender.unused_columns', shard_count)
+    print('Merged unused columns of {} shards'.format(shard_count))
+
+
+def main(client, project_name, max_concurrent_jobs=1, metadata_scope='region'):
+    unused_column(client, project_name, max_concurrent_jobs, metadata_scope)
     
@@ -33,9 +33,13 @@ Output: BQ table of the last time a column was called and how much money your or
 """
 
 import pandas as pd
+import metadata_cache
+import query_dispatch
+import sharding
+import table_writer
 
 
-def unused_table(client, project_name, discount):
+def unused_table(client, project_name, discount, max_concurrent_jobs=1, metadata_scope='region'):
     query_meta = """
     WITH calculate_last_call as (
       (
@@ -75,45 +79,85 @@ def unused_table(client, project_name, discount):
         ROUND(SUM(size_bytes)/POW(10,9),0) AS size_gb,
         ROUND(((SUM(size_bytes)/POW(10,9))*0.02)) as monthly_cost, 
         ROUND(((SUM(size_bytes)/POW(10,9))*(1-{discount})*0.02))*12 as annual_cost,  
-    FROM `{project}.{dataset}.`.__TABLES__ left join calculate_last_call using (project_id,dataset_id,table_id)
+    FROM {tables} left join calculate_last_call using (project_id,dataset_id,table_id)
     group by 1,2,3,4,5,6,7,8,9
     having severity_groups is not null
 
     """
 
+    # The tables of every dataset in a region of a project, in the same shape as __TABLES__
+    region_tables_query = """(
+        SELECT
+            tables.table_catalog AS project_id,
+            tables.table_schema AS dataset_id,
+            tables.table_name AS table_id,
+            CASE
+                WHEN tables.table_type = 'BASE TABLE' THEN 1
+                WHEN tables.table_type = 'VIEW' THEN 2
+                WHEN tables.table_type = 'EXTERNAL' THEN 3
+                ELSE NULL
+            END AS type,
+            UNIX_MILLIS(tables.creation_time) AS creation_time,
+            COALESCE(storage.total_logical_bytes, 0) AS size_bytes
+        FROM `{project}`.`{region}`.INFORMATION_SCHEMA.TABLES AS tables
+        LEFT JOIN `{project}`.`{region}`.INFORMATION_SCHEMA.TABLE_STORAGE AS storage
+            ON storage.table_schema = tables.table_schema AND storage.table_name = tables.table_name
+               AND NOT storage.deleted
+    )"""
+
     # GENERAL TABLE
     tables_total_df = pd.DataFrame(
         columns=['full_table', 'last_modified_date', 'severity_groups', 'size_gb', 'monthly_cost', 'annual_cost',
                  'last_called_by'])
 
-    projects = [x.project_id for x in client.list_projects()]
-
-    for project in projects:
-        datasets = list(client.list_datasets(project))
+    projects = metadata_cache.list_projects(client)
+    units = []
+    for project, datasets in query_dispatch.list_datasets(client, projects, max_concurrent_jobs):
         if datasets:
             print("Datasets in project {}:".format(project))
             for dataset in datasets:
-                try:
-                    df = client.query(
-                        query_meta.format(project_name=project_name, project=project, dataset=dataset.dataset_id,
-                                          discount=discount)).result().to_dataframe()
-                    if (len(df) > 0):
-                        tables_total_df = pd.concat([tables_total_df, df], ignore_index=True, sort=False)
-
-                except Exception as exe:
-                    print('Could not load since: ', str(exe)[:200])
-                    pass
-
-    # Changing the type of the data so BQ will be able to load it
-    tables_total_df.last_modified_date = tables_total_df.last_modified_date.astype('datetime64[ns]')
-    tables_total_df.monthly_cost = tables_total_df.monthly_cost.astype(float)
-    tables_total_df.annual_cost = tables_total_df.annual_cost.astype(float)
-    tables_total_df.size_gb = tables_total_df.size_gb.astype(float)
-
-    tables_total_df.to_gbq(destination_table='Data_Defender.unused_tables', project_id=project_name,
-                           if_exists='replace')  # Loading the dataframe into a BQ table
+                units.append((project, dataset.dataset_id, query_dispatch.dataset_region(dataset)))
+    units = sharding.select_datasets(units, metadata_scope == 'region')
+
+    def build_region_query(unit):
+        project, region = unit
+        tables = region_tables_query.format(project=project, region=region)
+        return query_meta.format(project_name=project_name, tables=tables, discount=discount)
+
+    def build_dataset_query(unit):
+        project, dataset = unit
+        tables = '`{}.{}.`.__TABLES__'.format(project, dataset)
+        return query_meta.format(project_name=project_name, tables=tables, discount=discount)
+
+    if metadata_scope == 'region':
+        results = query_dispatch.iter_region_results(client, units, build_region_query, build_dataset_query,
+                                                     max_concurrent_jobs, 'unused_tables')
+    else:
+        results = query_dispatch.iter_results(client, [(project, dataset) for project, dataset, region in units],
+                                              build_dataset_query, max_concurrent_jobs, 'unused_tables')
+    def prepare(df):
+        df = pd.concat([tables_total_df, df], ignore_index=True, sort=False)
+        # Changing the type of the data so BQ will be able to load it
+        df.last_modified_date = df.last_modified_date.astype('datetime64[ns]')
+        df.monthly_cost = df.monthly_cost.astype(float)
+        df.annual_cost = df.annual_cost.astype(float)
+        df.size_gb = df.size_gb.astype(float)
+        return df
+
+    # Loading the results into a BQ table as they come in
+    tables_writer = table_writer.TableWriter(client, project_name, sharding.table('Data_Defender.unused_tables'))
+    tables_writer.write(prepare(pd.DataFrame()))
+    for unit, df in results:
+        if (len(df) > 0):
+            tables_writer.write(prepare(df))
+    tables_writer.close()
     print('Finished unused tables')
 
 
-def main(client, project_name, discount):
-    unused_table(client, project_name, discount)
+def merge_shards(client, project_name, shard_count):
+    sharding.merge_union(client, project_name, 'Data_Defender.unused_tables', shard_count)
+    print('Merged unused tables of {} shards'.format(shard_count))
+
+
+def main(client, project_name, discount, max_concurrent_jobs=1, metadata_scope='region'):
+    unused_table(client, project_name, discount, max_concurrent_jobs, metadata_scope)
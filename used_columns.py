@@ -4,60 +4,272 @@ Input:
     1. Relevant credentials for BQ access
     2. Table of logs from total_logs.py
 Output: BQ table of the last time a column was called
+After the first run only the logs total_logs got since the previous run are parsed and merged into the table,
+unless a full refresh is asked for
 """
 
 
+from google.api_core.exceptions import NotFound
+import numpy as np
 import pandas as pd
-from google.cloud import bigquery
-from sql_metadata import Parser
-import re
+import bq_read
+import metrics
+from parse_cache import fingerprint
+import parse_pool
+import sharding
+import table_writer
+import total_logs
 
 
-def columns_parse(query):
-    try:
-        columns = Parser(query).columns
-        return columns
-    except Exception as exe:
-        print('Could not parse query')
-        pass
+# Matches the shard suffix of a table (e.g. events_20230101 or events_*) so sharded tables are counted as one table
+SHARD_SUFFIX_PATTERN = "_[0-9]{1,10}.*|\\_\\*"
+
+LOG_COLUMNS = ['last_run_date', 'project_id', 'dataset_id', 'table_id', 'query']
+TABLE_COLUMNS = ['dataset_id', 'project_id', 'table_id']
+
+# Columns repeated over many logs, dictionary encoded as they are downloaded; scheduled queries send the same text
+# again and again, so the query text is only held once per distinct query
+LOG_CATEGORIES = TABLE_COLUMNS + ['query']
+
+# Rows of logs downloaded before they are parsed when streaming the results
+STREAM_CHUNK_ROWS = 100000
+
+
+def parse_queries(queries, parse_cache=None, pool=None):
+    # Queries with the same fingerprint only differ in their literals, they share a group and one of them is parsed
+    # for all of them; returns the group of every query and the columns of every group
+    groups = {}
+    representatives = []
+    query_groups = np.empty(len(queries), dtype=np.int64)
+    for position, query in enumerate(queries):
+        key = fingerprint(query) if parse_cache is not None else query
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = len(representatives)
+            representatives.append(query)
+        elif parse_cache is not None:
+            # Counted as a hit, it is served by the entry of its representative
+            parse_cache.hits += 1
+        query_groups[position] = group
+
+    group_columns = [[]] * len(representatives)
+    group_errors = [None] * len(representatives)
+    to_parse = {}
+    for group, query in enumerate(representatives):
+        if parse_cache is not None:
+            found, columns = parse_cache.get(query)
+            if found:
+                if columns is None:
+                    group_errors[group] = 'Could not be parsed in a previous run'
+                group_columns[group] = columns or []
+                continue
+        to_parse[query] = group
+
+    pool = pool or parse_pool.ParsePool()
+    with metrics.span('parse', len(to_parse)):
+        for query, columns, error in pool.iter_parsed(list(to_parse)):
+            # A timeout may not happen again on a less busy run, so the query is not remembered as unparsable
+            if parse_cache is not None and not parse_pool.timed_out(error):
+                parse_cache.put(query, columns)
+            group_errors[to_parse[query]] = error
+            group_columns[to_parse[query]] = columns or []
+
+    unparsed_queries_df = pd.DataFrame([(query, group_errors[group]) for query, group in zip(queries, query_groups)
+                                        if group_errors[group]], columns=['query', 'error'])
+    return query_groups, group_columns, unparsed_queries_df
+
+
+def extract_used_columns(query_logs_df, parse_cache=None, pool=None):
+    # The query text is by far the biggest column of the logs, it is taken out of them as soon as it is read and
+    # every row only keeps the code of its query; the text comes dictionary encoded, so this only reads its codes
+    query_codes, queries = pd.factorize(query_logs_df.pop('query'))
+
+    # Every distinct query is parsed once, no matter how many tables it referenced, and the rows of queries that only
+    # differ in their literals are reduced together
+    query_groups, group_columns, unparsed_queries_df = parse_queries(queries, parse_cache, pool)
+    # A missing query has the code -1, it stays -1
+    query_codes = np.append(query_groups, -1)[query_codes]
+    query_columns = pd.Series(group_columns, dtype=object).explode().dropna()
+    query_columns_df = pd.DataFrame({'query_code': query_columns.index,
+                                     'column_name': pd.Categorical(query_columns.values)})
+
+    # The calls of a query to a table are reduced to the latest one before the rows are multiplied by its columns
+    logs_df = query_logs_df[TABLE_COLUMNS].assign(table_id=unsharded_tables(query_logs_df['table_id']),
+                                                  last_run_date=utc_dates(query_logs_df['last_run_date']),
+                                                  query_code=query_codes)
+    logs_df = logs_df.groupby(TABLE_COLUMNS + ['query_code'], sort=False, as_index=False,
+                              observed=True)['last_run_date'].max()
+    used_columns_df = logs_df.merge(query_columns_df, on='query_code').drop(columns='query_code')
+    return latest_used_columns(used_columns_df), unparsed_queries_df
+
+
+def unsharded_tables(table_ids):
+    # The shard suffix is removed from every distinct table once, the rows keep pointing at the tables by their code
+    table_ids = table_ids.astype('category')
+    codes, tables = pd.factorize(table_ids.cat.categories.astype(str).str.replace(SHARD_SUFFIX_PATTERN, '',
+                                                                                  regex=True))
+    return pd.Categorical.from_codes(np.append(codes, -1)[table_ids.cat.codes.values], tables)
+
+
+def utc_dates(dates):
+    # BQ timestamps come back in UTC, they are stored without a timezone
+    dates = pd.to_datetime(dates)
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert(None)
+    return dates
+
+
+def latest_used_columns(used_columns_df):
+    used_columns_df = used_columns_df.groupby(['dataset_id', 'project_id', 'table_id', 'column_name'], sort=False,
+                                              as_index=False, observed=True)['last_run_date'].max()
+    used_columns_df = used_columns_df.sort_values(by=['last_run_date'], axis=0, ascending=False, ignore_index=True)
+    used_columns_df.last_run_date = used_columns_df.last_run_date.astype('datetime64[ns]')
+    return used_columns_df
+
+
+def load_used_columns(client, query, parse_cache=None, pool=None, stream_results=False):
+    if not stream_results:
+        return extract_used_columns(bq_read.query_dataframe(client, query, LOG_CATEGORIES), parse_cache, pool)
+
+    # Each chunk of logs is reduced to its used columns as soon as it is downloaded, the chunks are merged at the end
+    used_columns_dfs = []
+    unparsed_queries_dfs = []
+    for query_logs_df in bq_read.iter_query_frames(client, query, STREAM_CHUNK_ROWS, LOG_CATEGORIES):
+        used_columns_df, unparsed_queries_df = extract_used_columns(query_logs_df, parse_cache, pool)
+        used_columns_dfs.append(used_columns_df)
+        unparsed_queries_dfs.append(unparsed_queries_df)
+    if not used_columns_dfs:
+        return extract_used_columns(pd.DataFrame(columns=LOG_COLUMNS))
+    return (latest_used_columns(bq_read.concat_frames(used_columns_dfs, TABLE_COLUMNS + ['column_name'])),
+            pd.concat(unparsed_queries_dfs, ignore_index=True).drop_duplicates(subset=['query']))
+
 
+def merge_used_columns(client, project_name, new_used_columns_df):
+    table_writer.write_table(client, project_name, 'Data_Defender.used_columns_staging', new_used_columns_df)
+    merge_staged_used_columns(client, project_name)
 
-def used_columns(client, project_name):
-    used_columns_df = pd.DataFrame(columns=['dataset_id', 'project_id', 'table_id', 'column_name', 'last_run_date'])
+
+def merge_staged_used_columns(client, project_name):
+    merge_query = """
+                        MERGE `{project_name}.Data_Defender.used_columns` AS used
+                        USING `{project_name}.Data_Defender.used_columns_staging` AS new_used
+                        ON used.project_id = new_used.project_id
+                            AND used.dataset_id = new_used.dataset_id
+                            AND used.table_id = new_used.table_id
+                            AND used.column_name = new_used.column_name
+                        WHEN MATCHED AND new_used.last_run_date > used.last_run_date THEN
+                            UPDATE SET last_run_date = new_used.last_run_date
+                        WHEN NOT MATCHED THEN
+                            INSERT ROW;
+
+                        DELETE FROM `{project_name}.Data_Defender.used_columns`
+                        WHERE last_run_date < TIMESTAMP(DATE_SUB(CURRENT_DATE(), INTERVAL {retention_days} day));
+                        """
+    bq_read.run_query(client, merge_query.format(project_name=project_name,
+                                                 retention_days=total_logs.RETENTION_DAYS))
+    client.delete_table('{}.Data_Defender.used_columns_staging'.format(project_name), not_found_ok=True)
+
+
+def used_columns(client, project_name, parse_cache=None, pool=None, full_refresh=False, stream_results=False):
     total_logs_query = """
-                        SELECT *
-                        FROM `{}.Data_Defender.Total_Logs` 
+                        SELECT {columns}
+                        FROM `{project_name}.Data_Defender.total_logs` {shard_filter}
                         """
-    query_logs_df = client.query(total_logs_query.format(project_name)).result().to_dataframe()
-
-    for index, query_log in query_logs_df.iterrows():
-        query_log = pd.DataFrame(query_log).reset_index()
-        query_log.rename(columns={query_log.columns[1]: 'query_str'}, inplace=True)
-        temp_query = str(query_log[query_log['index'] == 'query'].query_str.iloc[0])
-        query_columns = columns_parse(temp_query)
-        ch = '_'
-        # The Regex pattern to match al characters on and after '-'
-        pattern = ch + "[0-9]{1,10}.*|\_\*"
-        # Remove all characters after the character '-' from string
-        query_log.values[5, 1] = re.sub(pattern, '', query_log.values[5, 1])
-        if query_columns:
-            for col in query_columns:
-                temp_df = pd.DataFrame({
-                    'last_run_date': str(query_log[query_log['index'] == 'last_run_date'].query_str.iloc[0]),
-                    'project_id': str(query_log[query_log['index'] == 'project_id'].query_str.iloc[0]),
-                    'dataset_id': str(query_log[query_log['index'] == 'dataset_id'].query_str.iloc[0]),
-                    'table_id': str(query_log[query_log['index'] == 'table_id'].query_str.iloc[0]),
-                    'column_name': col}, index=[0])
-                used_columns_df = pd.concat((used_columns_df, temp_df), ignore_index=True, axis=0)
-
-    used_columns_df = used_columns_df.sort_values(by=['last_run_date'],
-                                                      axis = 0, ascending=False)
-    used_columns_df = used_columns_df.drop_duplicates(subset=['project_id', 'dataset_id', 'table_id', 'column_name'],
-                                                      keep='first')
-    used_columns_df.last_run_date = used_columns_df.last_run_date.astype('datetime64[ns]')
-    used_columns_df.to_gbq(destination_table='Data_Defender.used_columns', project_id=project_name, if_exists='replace')
+    # Only the logs total_logs got since the previous run have to be parsed again, whatever day they were called on
+    new_logs_query = """
+                        SELECT {columns}
+                        FROM `{project_name}.{changes_table}` {shard_filter}
+                        """
+    incremental = has_used_columns(client, project_name, full_refresh)
+    shard_projects = None
+    shard_filter = ''
+    if sharding.enabled():
+        shard_projects = select_shard_projects(client, project_name)
+        shard_filter = 'WHERE project_id IN ({})'.format(', '.join(quote(project) for project in shard_projects))
+    if incremental:
+        query = new_logs_query.format(project_name=project_name, columns=', '.join(LOG_COLUMNS),
+                                      changes_table=total_logs.CHANGES_TABLE, shard_filter=shard_filter)
+    else:
+        query = total_logs_query.format(project_name=project_name, columns=', '.join(LOG_COLUMNS),
+                                        shard_filter=shard_filter)
+
+    if shard_projects == [] or (incremental and not has_changes(client, project_name)):
+        used_columns_df, unparsed_queries_df = extract_used_columns(pd.DataFrame(columns=LOG_COLUMNS))
+    else:
+        used_columns_df, unparsed_queries_df = load_used_columns(client, query, parse_cache, pool, stream_results)
+    if sharding.enabled():
+        # The merge step stores the columns of all the shards the same way a single process would have
+        table_writer.write_table(client, project_name, sharding.table('Data_Defender.used_columns'), used_columns_df)
+    elif not incremental:
+        table_writer.write_table(client, project_name, 'Data_Defender.used_columns', used_columns_df)
+    elif len(used_columns_df) > 0:
+        merge_used_columns(client, project_name, used_columns_df)
+    if not sharding.enabled():
+        drop_changes(client, project_name)
+    if len(unparsed_queries_df) > 0:
+        print('Could not parse {} queries, see Data_Defender.unparsed_queries'.format(len(unparsed_queries_df)))
+    table_writer.write_table(client, project_name, sharding.table('Data_Defender.unparsed_queries'),
+                             unparsed_queries_df)
     print('Finished used columns')
 
 
-def main(client, project_name):
-    used_columns(client, project_name)
+def has_used_columns(client, project_name, full_refresh=False):
+    if full_refresh:
+        return False
+    try:
+        client.get_table('{}.Data_Defender.used_columns'.format(project_name))
+    except Exception as exe:
+        print('Could not load the previous used columns, parsing all the logs')
+        return False
+    return True
+
+
+def has_changes(client, project_name):
+    try:
+        client.get_table('{}.{}'.format(project_name, total_logs.CHANGES_TABLE))
+    except NotFound:
+        print('No new logs since the previous run')
+        return False
+    return True
+
+
+def drop_changes(client, project_name):
+    # The changed logs are parsed, the next run only parses the ones total_logs gets after this one
+    client.delete_table('{}.{}'.format(project_name, total_logs.CHANGES_TABLE), not_found_ok=True)
+
+
+def quote(value):
+    return "'{}'".format(str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def select_shard_projects(client, project_name):
+    # The logs are split by the project of the tables they called, weighted by their number of logs
+    projects_query = """
+                        SELECT project_id, COUNT(*) AS log_rows
+                        FROM `{project_name}.Data_Defender.total_logs`
+                        GROUP BY project_id
+                        ORDER BY project_id
+                        """
+    projects_df = bq_read.query_dataframe(client, projects_query.format(project_name=project_name))
+    return sharding.select(list(projects_df.project_id), [int(rows) for rows in projects_df.log_rows], 'projects')
+
+
+def merge_shards(client, project_name, shard_count, full_refresh=False):
+    # The workers parsed only the new logs if the used columns were already stored, and they still are
+    if has_used_columns(client, project_name, full_refresh):
+        sharding.merge_union(client, project_name, 'Data_Defender.used_columns_staging', shard_count,
+                             'Data_Defender.used_columns')
+        merge_staged_used_columns(client, project_name)
+    else:
+        sharding.merge_union(client, project_name, 'Data_Defender.used_columns', shard_count)
+
+    # A query that called tables of several projects is reported by every shard that had one of them
+    unparsed_query = 'SELECT query, ANY_VALUE(error) AS error FROM (\n{}\n) GROUP BY query'
+    sharding.merge_union(client, project_name, 'Data_Defender.unparsed_queries', shard_count,
+                         select_query=unparsed_query)
+    drop_changes(client, project_name)
+    print('Merged used columns of {} shards'.format(shard_count))
+
+
+def main(client, project_name, parse_cache=None, pool=None, full_refresh=False, stream_results=False):
+    used_columns(client, project_name, parse_cache, pool, full_refresh, stream_results)